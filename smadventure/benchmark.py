@@ -0,0 +1,347 @@
+"""
+Tick benchmarks over seeded synthetic worlds.
+
+Builds worlds of a given size out of the real entity types in etypes/,
+ticks them, and reports throughput, tick time percentiles, peak RSS and
+allocations per tick, plus a few micro-benchmarks. Results can be saved
+as JSON and compared against an earlier run:
+
+    python -m smadventure.benchmark --sizes 1000,10000 --out before.json
+    python -m smadventure.benchmark --sizes 1000,10000 --compare before.json
+"""
+
+import argparse
+import glob
+import json
+import logging
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+import trio
+
+try:
+    import resource
+
+except ImportError:
+    resource = None
+
+from collections import Counter
+
+from . import engine
+
+
+
+def synthetic_world(entities, places=None, degree=3, seed=0, etype_files='etypes/*.xml'):
+    """Returns a GameWorld with the given number of entities, spread
+    over places (by default one per 25 entities) joined by paths.
+
+    Places form a ring, so the world is always connected, plus random
+    extra paths until places average degree neighbours. Everything,
+    from entity types to variants, is picked with the given seed."""
+    rng = random.Random(seed)
+
+    if places is None:
+        places = max(entities // 25, 2)
+
+    loader = engine.XMLGameLoader()
+    world = engine.GameWorld(seed=seed)
+    holder = loader.new_funcholder()
+
+    for fn in sorted(glob.glob(etype_files)):
+        etype, items = loader.load_entity_type(world, fn, holder)
+        world.etypes[etype.id] = etype
+
+        for item in items:
+            world.item_types[item['name']] = item
+
+    holder.deinit()
+
+    names = ['Place {}'.format(i) for i in range(places)]
+    world.beginning = names[0]
+
+    for name in names:
+        items = {t: rng.randint(5, 40) for t in sorted(world.item_types) if rng.random() < 0.5}
+        world.places[name] = { 'name': name, 'attr': {}, 'items': items, 'stock': dict(items) }
+
+    for i in range(places):
+        world.add_path((names[i], names[(i + 1) % places]))
+
+    extra = max(0, places * degree // 2 - places)
+
+    for _ in range(extra):
+        a, b = rng.sample(names, 2)
+
+        if not world.is_adjacent(a, b):
+            world.add_path((a, b))
+
+    # Player variants are left out; a player without a bot attached
+    # never does anything.
+    kinds = []
+
+    for etype in sorted(world.etypes.values(), key=lambda t: t.id):
+        variants = [vid for vid in sorted(etype.variants) if not etype.lookup[vid].get('isPlayer')]
+
+        if variants:
+            kinds.append((etype.id, variants))
+
+    groups = Counter()
+
+    for _ in range(entities):
+        groups[(rng.choice(names), rng.randrange(len(kinds)))] += 1
+
+    for (place, k), count in sorted(groups.items()):
+        etype, variants = kinds[k]
+        world.spawn_many(etype, place, [rng.choice(variants) for _ in range(count)], count)
+
+    return world
+
+def peak_rss():
+    """Peak resident set size of this process in kilobytes, if known."""
+    if resource is None:
+        return None
+
+    res = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if sys.platform == 'darwin':
+        res //= 1024 # bytes there
+
+    return res
+
+def percentile(values, p):
+    values = sorted(values)
+
+    if not values:
+        return None
+
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def bench_ticks(world, ticks, alloc_ticks=2):
+    """Ticks a world, returning tick statistics. The last alloc_ticks
+    ticks run under tracemalloc, so they are left out of the timings."""
+    times = []
+
+    for _ in range(ticks):
+        start = time.perf_counter()
+        trio.run(world.tick)
+        times.append(time.perf_counter() - start)
+
+    allocated = []
+    blocks = []
+
+    for _ in range(alloc_ticks):
+        tracemalloc.start()
+        before = sys.getallocatedblocks()
+
+        trio.run(world.tick)
+
+        blocks.append(sys.getallocatedblocks() - before)
+        allocated.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    total = sum(times)
+
+    return {
+        'ticks': ticks,
+        'ticks_per_sec': ticks / total if total else None,
+        'tick_p50_ms': percentile(times, 50) * 1000 if times else None,
+        'tick_p99_ms': percentile(times, 99) * 1000 if times else None,
+        'peak_alloc_per_tick_kb': max(allocated) / 1024 if allocated else None,
+        'net_blocks_per_tick': sum(blocks) / len(blocks) if blocks else None,
+        'entities_after': len(world.entities),
+    }
+
+def _rate(fn, loops):
+    start = time.perf_counter()
+    fn(loops)
+    took = time.perf_counter() - start
+
+    return {
+        'loops': loops,
+        'ns_per_op': took / loops * 1e9,
+        'ops_per_sec': loops / took if took else None,
+    }
+
+def bench_micro(world, loops=100000, seed=0):
+    """Micro-benchmarks of the hottest engine paths."""
+    rng = random.Random(seed)
+    ents = [e for e in world if 'pathmove' in e.type.functions and not e['dead']]
+    places = sorted(world.places)
+    res = {}
+
+    if not ents:
+        return res
+
+    sample = [rng.choice(ents) for _ in range(1024)]
+
+    def getitem(n):
+        for i in range(n):
+            sample[i & 1023]['health']
+
+    def call(n):
+        # Already being there is pathmove's cheapest way out, which
+        # leaves mostly the call machinery itself.
+        for i in range(n):
+            e = sample[i & 1023]
+            e.call('pathmove', e.place)
+
+    def in_place(n):
+        for i in range(n):
+            for e in world.all_in_place(places[i % len(places)]):
+                pass
+
+    def pathmove(n):
+        for i in range(n):
+            if i % 1024 == 0:
+                world.pathfinder.invalidate()
+
+            sample[i & 1023].call('pathmove', places[rng.randrange(len(places))])
+
+    res['getitem'] = _rate(getitem, loops)
+    res['call'] = _rate(call, loops)
+    res['all_in_place'] = _rate(in_place, max(loops // 100, 1))
+    res['pathmove'] = _rate(pathmove, max(loops // 10, 1))
+    res['broadcast'] = bench_broadcast(world, max(loops // 10, 1))
+
+    return res
+
+def bench_broadcast(world, count):
+    """Measures how fast queued broadcasts reach a channel."""
+    received = [0]
+
+    async def sink(message, place, level):
+        received[0] += 1
+
+    world.add_broadcast_channel(-10, sink, name='benchmark')
+
+    async def run():
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(world._broadcast_loop)
+
+            start = time.perf_counter()
+
+            for i in range(count):
+                world.broadcast(0, 'Message ', i, place='Place 0')
+
+            while received[0] < count:
+                await trio.sleep(0)
+
+            took = time.perf_counter() - start
+            nursery.cancel_scope.cancel()
+
+        return took
+
+    try:
+        took = trio.run(run)
+
+    finally:
+        world.remove_broadcast_channel('benchmark')
+
+    return {
+        'loops': count,
+        'ns_per_op': took / count * 1e9,
+        'ops_per_sec': count / took if took else None,
+    }
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(sizes, ticks, places=None, degree=3, seed=0, loops=100000, micro=True, columns=False):
+    results = {
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'seed': seed,
+        'columns': columns,
+        'worlds': [],
+    }
+
+    for size in sizes:
+        start = time.perf_counter()
+        world = synthetic_world(size, places, degree, seed)
+
+        if columns:
+            world.enable_columns()
+
+        built = time.perf_counter() - start
+
+        res = {
+            'entities': size,
+            'places': len(world.places),
+            'paths': len(world.paths),
+            'build_sec': built,
+        }
+
+        res.update(bench_ticks(world, ticks))
+
+        if micro:
+            res['micro'] = bench_micro(world, loops, seed)
+
+        res['peak_rss_kb'] = peak_rss()
+        results['worlds'].append(res)
+
+        print(_summary(res))
+
+    return results
+
+def _summary(res):
+    def num(key, width):
+        # (None when no ticks were timed)
+        return '{:{}.2f}'.format(res[key], width) if res[key] is not None else '-'.rjust(width)
+
+    return '{:>8} entities, {:>6} places: {} ticks/s, p50 {} ms, p99 {} ms'.format(res['entities'], res['places'], num('ticks_per_sec', 8), num('tick_p50_ms', 9), num('tick_p99_ms', 9))
+
+def compare(old, new):
+    """Prints how each metric changed between two result sets."""
+    old_worlds = {w['entities']: w for w in old['worlds']}
+
+    for w in new['worlds']:
+        o = old_worlds.get(w['entities'])
+
+        if o is None:
+            continue
+
+        print('{} entities ({} -> {}):'.format(w['entities'], (old.get('revision') or '?')[:10], (new.get('revision') or '?')[:10]))
+
+        pairs = [(k, o.get(k), w.get(k)) for k in ('ticks_per_sec', 'tick_p50_ms', 'tick_p99_ms', 'peak_alloc_per_tick_kb')]
+        pairs += [('micro.' + k, o.get('micro', {}).get(k, {}).get('ns_per_op'), v['ns_per_op']) for k, v in w.get('micro', {}).items()]
+
+        for key, a, b in pairs:
+            if a and b:
+                print('  {:<28} {:>12.2f} -> {:>12.2f} ({:+.1f}%)'.format(key, a, b, (b - a) / a * 100))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m smadventure.benchmark', description='Benchmarks GameWorld ticks over seeded synthetic worlds.')
+    parser.add_argument('--sizes', default='1000,10000', help='comma separated entity counts (e.g. 1000,10000,100000,1000000)')
+    parser.add_argument('--ticks', type=int, default=10, help='timed ticks per world')
+    parser.add_argument('--places', type=int, default=None, help='place count (default: one per 25 entities)')
+    parser.add_argument('--degree', type=int, default=3, help='average number of neighbours per place')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--loops', type=int, default=100000, help='micro-benchmark iterations')
+    parser.add_argument('--no-micro', action='store_true', help='skip micro-benchmarks')
+    parser.add_argument('--columns', action='store_true', help='run the vectorized bulk systems (see GameWorld.enable_columns); experimental, for measuring them against the plain path')
+    parser.add_argument('--out', help='write JSON results to this file')
+    parser.add_argument('--compare', help='compare against earlier JSON results')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    sizes = [int(s) for s in args.sizes.split(',') if s]
+    results = run(sizes, args.ticks, args.places, args.degree, args.seed, args.loops, not args.no_micro, args.columns)
+
+    if args.out:
+        with open(args.out, 'w') as fp:
+            json.dump(results, fp, indent=4)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(json.load(fp), results)
+
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+"""
+Precompiled world bundles.
+
+Every time it loads a world, XMLGameLoader parses XML, resolves
+attribute library imports, evaluates attribute values and compiles
+embedded code. Where content only changes on release, all of that can
+be done once, ahead of time, into a bundle:
+
+    python -m smadventure.bundle mushworld.xml
+
+A bundle holds everything loading a world file comes up with before
+spawning anything: entity types (variants merged with their base
+attributes), item types, places with the steps that populate them,
+paths, and the compiled code of every function and system.
+BundleGameLoader builds worlds from it without reading any XML; given
+the same seed, they come out the same as XMLGameLoader's.
+
+A bundle also lists the files it was built from, with their sizes and
+modification times. Once any of them changes, the bundle is stale, and
+BundleGameLoader rebuilds it before loading. Bundles hold code objects,
+so like .pyc files they only work with the Python version that built
+them; other versions rebuild them as well.
+"""
+
+import argparse
+import importlib.util
+import logging
+import marshal
+import os
+import struct
+import time
+
+from . import engine, embedcode
+
+
+
+MAGIC = b'SMADBNDL'
+FORMAT_VERSION = 2
+
+_HEADER = struct.Struct('<HH4s') # format version, marshal version, Python bytecode magic
+
+
+def default_path(world_file):
+    return '{}.bundle'.format(world_file)
+
+def _stat(path):
+    st = os.stat(path)
+
+    return (st.st_mtime_ns, st.st_size)
+
+def freeze(holder, etypes, item_types):
+    """Turns entity types and item types loaded through a CodeHolder
+    into marshallable values, as stored in bundles."""
+    # Functions (and the function tables of attribute library items)
+    # are stored as references to the code that defines them.
+    refs = {}
+    attrs = {}
+
+    for key, funcs in holder.cache.items():
+        refs[id(funcs)] = ('table', key)
+
+        for name, f in funcs.items():
+            if id(f) not in refs:
+                refs[id(f)] = ('function', key, name)
+
+                extra = {a: v for a, v in getattr(f, '__dict__', {}).items() if a != '__lookup_name__'}
+
+                if extra:
+                    attrs[(key, name)] = extra
+
+    def ref(f):
+        return refs[id(f)]
+
+    return {
+        'code': [(key, compiled, digest) for key, (compiled, digest) in holder.compiled.items()],
+        'attrs': attrs,
+        'etypes': [{
+            'name': t.name,
+            'id': t.id,
+            'filename': t.filename,
+            'base': t.base_attributes,
+            'variants': {vid: dict(v, systems=[ref(f) for f in v['systems']]) for vid, v in t.variants.items()},
+            'functions': {name: ref(f) for name, f in t.functions.items()},
+            'systems': [ref(f) for f in t.systems],
+            'default': t.default_attr,
+        } for t in etypes],
+        'item_types': {name: dict(i, functions={n: ref(f) for n, f in i['functions'].items()}) for name, i in item_types.items()},
+    }
+
+def build(world_file):
+    """Loads a world file's content the way XMLGameLoader does, and
+    returns it as a bundle (a dict of marshallable values)."""
+    loader = engine.XMLGameLoader()
+    holder = loader.new_funcholder()
+    layout = loader.read_world(world_file)
+
+    etypes = []
+    item_types = {}
+
+    for fn in layout['etypes']:
+        etype, items = loader.load_entity_type(None, fn, holder)
+        etypes.append(etype)
+
+        for item in items:
+            item_types[item['name']] = item
+
+    content = freeze(holder, etypes, item_types)
+    content['sources'] = {path: _stat(path) for path in loader.sources}
+    content['layout'] = layout
+
+    return content
+
+def compile_etype(filename):
+    """Loads a single entity type file and returns it frozen (see
+    freeze), marshalled, along with the files read. Runs in worker
+    processes; see streaming.StreamingGameLoader."""
+    loader = engine.XMLGameLoader()
+    holder = loader.new_funcholder()
+    etype, items = loader.load_entity_type(None, filename, holder)
+
+    content = freeze(holder, [etype], {i['name']: i for i in items})
+    content['sources'] = list(loader.sources)
+
+    return marshal.dumps(content)
+
+def save(content, filename):
+    """Writes a bundle made by build to a file, atomically."""
+    tmp = '{}.tmp'.format(filename)
+
+    with open(tmp, 'wb') as fp:
+        fp.write(MAGIC)
+        fp.write(_HEADER.pack(FORMAT_VERSION, marshal.version, importlib.util.MAGIC_NUMBER))
+
+        # Sources go first, so that checking them doesn't take reading
+        # the rest.
+        marshal.dump(content['sources'], fp)
+        marshal.dump({k: v for k, v in content.items() if k != 'sources'}, fp)
+
+    os.replace(tmp, filename)
+
+def load(filename):
+    """Reads a bundle file. Returns None if there is none, or if it is
+    stale or was built by another Python or bundle format version."""
+    try:
+        fp = open(filename, 'rb')
+
+    except FileNotFoundError:
+        return None
+
+    with fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a world bundle!")
+
+        version, marshal_version, magic = _HEADER.unpack(fp.read(_HEADER.size))
+
+        if version != FORMAT_VERSION or magic != importlib.util.MAGIC_NUMBER:
+            return None
+
+        sources = marshal.load(fp)
+
+        for path, stat in sources.items():
+            try:
+                if _stat(path) != stat:
+                    return None
+
+            except OSError:
+                return None
+
+        content = marshal.load(fp)
+        content['sources'] = sources
+
+        return content
+
+def instantiate(world, content, holder=None):
+    """Adds the entity types and item types of a bundle, or anything
+    else made by freeze, to a world. When merging several, pass the
+    same holder each time: like with CodeHolder.quick, code already
+    run under a key wins over later code for it."""
+    if holder is None:
+        holder = embedcode.CodeHolder(cache_dir=None)
+
+    for key, compiled, digest in content['code']:
+        if key not in holder.cache:
+            holder.run(key, compiled, digest)
+
+    for (key, name), extra in content['attrs'].items():
+        for a, v in extra.items():
+            setattr(holder.cache[key][name], a, v)
+
+    def resolve(r):
+        if r[0] == 'table':
+            return holder.cache[r[1]]
+
+        return holder.cache[r[1]][r[2]]
+
+    for t in content['etypes']:
+        variants = {vid: dict(v, systems=[resolve(r) for r in v['systems']]) for vid, v in t['variants'].items()}
+        functions = {name: resolve(r) for name, r in t['functions'].items()}
+
+        etype = world.etypes[t['id']] = engine.EntityType(t['name'], t['id'], t['base'], variants, functions, [resolve(r) for r in t['systems']], t['default'])
+        etype.filename = t['filename']
+
+    for name, i in content['item_types'].items():
+        world.item_types[name] = dict(i, functions={n: resolve(r) for n, r in i['functions'].items()})
+
+
+class BundleGameLoader(engine.XMLGameLoader):
+    """Loads worlds from their bundle, by default the world file's name
+    plus '.bundle', first building it if it's missing or stale. If the
+    bundle can't be written, the world still loads, only without one."""
+
+    def __init__(self, bundle_file=None):
+        super().__init__()
+
+        self.bundle_file = bundle_file
+
+    def load_world(self, filename, populate=True, world_class=None, seed=None):
+        bundle_file = self.bundle_file or default_path(filename)
+        content = load(bundle_file)
+
+        if content is None:
+            logging.info("World bundle {} is missing or out of date; building it...".format(bundle_file))
+            content = build(filename)
+
+            try:
+                save(content, bundle_file)
+
+            except OSError:
+                logging.warning("Could not save the world bundle {}".format(bundle_file), exc_info=True)
+
+        world = (world_class or engine.GameWorld)(beginning=content['layout']['beginning'], seed=seed)
+
+        instantiate(world, content)
+        self.build_places(world, content['layout'], populate)
+
+        return world
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m smadventure.bundle', description='Builds a precompiled bundle of a world file and everything it uses.')
+    parser.add_argument('world', help='world file (e.g. mushworld.xml)')
+    parser.add_argument('-o', '--out', help='bundle file (default: the world file plus .bundle)')
+    args = parser.parse_args(argv)
+
+    out = args.out or default_path(args.world)
+    start = time.perf_counter()
+    content = build(args.world)
+
+    save(content, out)
+
+    print('Built {} from {} files in {:.2f}s ({} entity types, {} code fragments).'.format(out, len(content['sources']), time.perf_counter() - start, len(content['etypes']), len(content['code'])))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+Optional vectorized bulk systems for hot numeric creature attributes.
+
+When enabled through GameWorld.enable_columns, the per-tick updates
+named in GameWorld.bulk_systems (burn damage rolls, aging, gestation)
+are taken out of creature_tick. Instead of doing them one creature at a
+time, creature_tick queues each creature where it used to do the work
+(see GameWorld.bulk_queue), so exactly the same creatures are updated
+as without columns: e.g. only idle ones age. Once every entity has
+ticked, each bulk system gathers the attributes it needs from the
+creatures queued for it into NumPy arrays (one slot per creature),
+updates them all at once, and writes back what changed, calling into
+scripts only for the few creatures that crossed a threshold.
+
+Attributes stay in the entities' plain dicts the whole time, so reading
+and writing them from scripts costs the same with or without columns;
+only the bulk passes pay for the copying. Writes go through
+LoadedEntity, so the journal hears about them as usual.
+
+Within a tick, the bulk systems run after every entity ticked, so e.g.
+a burning creature gets to act before its burn damage for the tick is
+rolled.
+"""
+
+try:
+    import numpy
+
+except ImportError:
+    numpy = None
+
+
+# The numeric attributes the bulk systems gather, and the array type
+# they are gathered as.
+CREATURE_COLUMNS = {
+    'humor': float,
+    'age': int,
+    'pregnant': float,
+}
+
+
+def _read(entity, key):
+    # (LoadedEntity.__getitem__, minus the method call)
+    a = entity.spl[5].get(key)
+    return a if a is not None else entity._table.get(key)
+
+
+class ColumnStore(object):
+    """Collects the creatures queued for each bulk system during a tick,
+    and gathers their attributes into arrays for the passes."""
+
+    def __init__(self, spec=CREATURE_COLUMNS, rng=None):
+        if numpy is None:
+            raise RuntimeError("NumPy is required for columnar attribute storage!")
+
+        self.spec = dict(spec)
+        self.rng = rng if rng is not None else numpy.random.default_rng()
+
+        self.queued = {} # enabled bulk system name -> entities queued this tick
+
+    def gather(self, entities, key, values=None):
+        """An array of the given attribute of each entity (falling back
+        to its variant's, like LoadedEntity), one slot per entity.
+        values, if given, is a list the plain values are appended to."""
+        if values is None:
+            values = []
+
+        values.extend([_read(e, key) for e in entities])
+
+        return numpy.array(values, dtype=self.spec[key])
+
+    def scatter(self, world, entities, key, values):
+        """Writes values (a list) back into the given attribute of each
+        entity. Bypasses LoadedEntity, but not the journal."""
+        for e, v in zip(entities, values):
+            e.spl[5][key] = v
+
+        if world.journal is not None:
+            for e in entities:
+                world.journal.touch(e.spl[0])
+
+    def run(self, world):
+        """Runs every enabled bulk system over the entities queued for
+        it since the last run. Called by GameWorld.tick once every
+        entity ticked."""
+        queued = self.queued
+        self.queued = {name: [] for name in queued}
+
+        for name, system in world.bulk_systems.items():
+            entities = [e for e in queued.get(name, ()) if not e.despawned]
+
+            if entities:
+                system(world, entities)
+
+
+# Vectorized bulk systems. Each takes the world and the (live)
+# entities queued for it this tick, and mirrors the matching part of
+# creature_tick.
+
+def burning_pass(world, entities):
+    rng = world.columns.rng
+
+    hurt = rng.random(len(entities)) <= 0.5
+    damage = rng.uniform(2, 9, len(entities))
+    out = rng.random(len(entities)) <= 0.15
+
+    for e, h, dmg, o in zip(entities, hurt.tolist(), damage.tolist(), out.tolist()):
+        # (burnt or killed to death earlier this tick; removals wait
+        # until the tick is over)
+        if e.despawned or e['dead']:
+            continue
+
+        if h:
+            world.broadcast(1, "Ouch! ", e, " is taking burn damage!", place=e.place)
+            e['instigator'] = e['burnInstigator']
+            e.call("take_damage", dmg)
+
+            if e.despawned or e['dead']:
+                continue
+
+        if o and e['burning']:
+            e['burning'] = False
+            world.broadcast(1, e, "'s flames have extinguished naturally.", place=e.place)
+
+def aging_pass(world, entities):
+    store = world.columns
+
+    age = store.gather(entities, 'age')
+    age -= store.rng.integers(1, 4, len(entities))
+
+    store.scatter(world, entities, 'age', age.tolist())
+
+    for i in numpy.flatnonzero(age <= 0).tolist():
+        if entities[i]['baby']:
+            entities[i].call('grow_up')
+
+def gestation_pass(world, entities):
+    store = world.columns
+
+    before, humor = [], []
+    pregnant = store.gather(entities, 'pregnant', before) - store.gather(entities, 'humor', humor)
+
+    values = pregnant.tolist()
+    born = numpy.flatnonzero(pregnant <= 0).tolist()
+
+    # (an int minus an int stays an int, like in creature_tick)
+    for i, (p, h) in enumerate(zip(before, humor)):
+        if type(h) is int and type(p) is int:
+            values[i] = int(values[i])
+
+    for i in born:
+        values[i] = 0
+
+    store.scatter(world, entities, 'pregnant', values)
+
+    for i in born:
+        entities[i].call('give_birth')
+
+
+BULK_SYSTEMS = {
+    'burning': burning_pass,
+    'aging': aging_pass,
+    'gestation': gestation_pass,
+}
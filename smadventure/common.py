@@ -1,21 +1,78 @@
 import math
 
 
+# Nouns that don't take the usual endings, by singular.
+_IRREGULAR_PLURALS = {
+    'sheep': 'sheep', 'deer': 'deer', 'fish': 'fish', 'moose': 'moose',
+    'wheat': 'wheat', 'wool': 'wool', 'straw': 'straw',
+    'tooth': 'teeth', 'foot': 'feet', 'goose': 'geese', 'mouse': 'mice',
+    'man': 'men', 'woman': 'women', 'child': 'children', 'person': 'people',
+    'leaf': 'leaves', 'thief': 'thieves', 'wolf': 'wolves', 'knife': 'knives', 'life': 'lives',
+}
+
 def plural(name: str, amount: int = 2):
+    """Makes a name plural unless amount is 1, e.g. 'Red Fox' -> 'Red
+    Foxes', 'Baby Sheep' -> 'Baby Sheep'. Only the last word changes;
+    see _IRREGULAR_PLURALS for the nouns that don't follow the usual
+    endings."""
     if amount == 1:
         return name
 
-    elif name.endswith('us') or name.endswith('is'):
-        return name[:-2] + 'i'
+    head, sep, word = name.rpartition(' ')
+    irregular = _IRREGULAR_PLURALS.get(word.lower())
+
+    if irregular is not None:
+        word = (irregular[0].upper() + irregular[1:]) if word[:1].isupper() else irregular
+
+    elif word.endswith('us') or word.endswith('is'):
+        word = word[:-2] + 'i'
+
+    elif word.endswith('ff'):
+        word = word[:-2] + 'ves'
+
+    elif word.endswith(('s', 'x', 'z', 'ch', 'sh')):
+        word = word + 'es'
+
+    elif word.endswith('y') and word[-2:-1] not in ('', 'a', 'e', 'i', 'o', 'u'):
+        word = word[:-1] + 'ies'
+
+    else:
+        word = word + 's'
+
+    return head + sep + word
 
-    elif name.endswith('ff'):
-        return name[:-2] + 'ves'
-        
-    elif name.endswith('s'):
-        return name + 'es'
+_PLURAL_VERBS = {'is': 'are', 'has': 'have', 'was': 'were', 'does': 'do', 'goes': 'go'}
+
+def plural_verb(text: str, amount: int = 2):
+    """Makes the text following a subject agree with amount of it,
+    e.g. ' attacks X!' -> ' attack X!', "'s flames" -> "' flames".
+    Only the first word is changed, and only if it looks like a verb
+    in the present tense."""
+    if amount == 1:
+        return text
+
+    if text.startswith("'s"):
+        return "'" + text[2:]
+
+    lead = text[:len(text) - len(text.lstrip())]
+    word, sep, rest = text[len(lead):].partition(' ')
+
+    if word in _PLURAL_VERBS:
+        word = _PLURAL_VERBS[word]
+
+    elif not word.isalpha() or not word.islower() or word.endswith('ss') or not word.endswith('s'):
+        return text
+
+    elif word.endswith('ies') and len(word) > 4:
+        word = word[:-3] + 'y'
+
+    elif word.endswith(('sses', 'shes', 'ches', 'xes', 'zes')):
+        word = word[:-2]
 
     else:
-        return name + 's'
+        word = word[:-1]
+
+    return lead + word + sep + rest
 
 def size_cm(centimetres: float):
     if centimetres < 100:
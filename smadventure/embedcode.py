@@ -1,21 +1,110 @@
+import dis
+import hashlib
+import importlib.util
+import logging
+import marshal
+import os
 import textwrap
+import types
 
 
 
+CACHE_DIR = '.codecache' # under the loader's base path, see XMLGameLoader
+
+# Values a fragment may leave in its namespace and still share it with
+# identical fragments.
+_SHAREABLE = (types.FunctionType, types.BuiltinFunctionType, types.ModuleType, type, int, float, complex, str, bytes, bool, tuple, frozenset, type(None))
+
+def _shareable(value):
+    """Whether a value left in a fragment's namespace holds no state
+    of its own, down to the contents of tuples and the defaults and
+    attributes of functions."""
+    if isinstance(value, (tuple, frozenset)):
+        return all(_shareable(v) for v in value)
+
+    if isinstance(value, types.FunctionType):
+        return all(_shareable(v) for v in (value.__defaults__ or ())) and all(_shareable(v) for v in (value.__kwdefaults__ or {}).values()) and all(_shareable(v) for v in value.__dict__.values())
+
+    return isinstance(value, _SHAREABLE)
+
+_GLOBAL_WRITES = {'STORE_GLOBAL', 'DELETE_GLOBAL'}
+_GLOBAL_WRITE_OPS = [bytes([dis.opmap[op]]) for op in _GLOBAL_WRITES]
+
+def _rebinds_globals(compiled):
+    """Whether any function in a compiled fragment assigns or deletes
+    global variables."""
+    for const in compiled.co_consts:
+        if isinstance(const, types.CodeType):
+            # Disassembling is slow; most functions don't even have
+            # either opcode's byte anywhere in their bytecode.
+            code = const.co_code
+
+            if any(op in code for op in _GLOBAL_WRITE_OPS) and any(ins.opname in _GLOBAL_WRITES for ins in dis.get_instructions(const)):
+                return True
+
+            if _rebinds_globals(const):
+                return True
+
+    return False
+
+def _script_globals():
+    """A fresh namespace for a fragment to run in, holding what
+    embedded code is meant to see besides builtins."""
+    from . import namegen
+
+    return {
+        '__name__': __name__,
+        '__package__': __package__, # (for relative imports, e.g. from .common)
+        '__builtins__': __builtins__,
+        'namegen': namegen,
+    }
+
+
 class CodeHolder:
-    def __init__(self):
+    """Compiles and runs embedded code fragments (functions from entity
+    types and attribute libraries, systems), handing out the functions
+    each one defines.
+
+    Compiled code is kept on disk in cache_dir (None to disable it),
+    keyed by a hash of the source, line padding included, and file
+    name, so warm restarts compile nothing. A fragment identical to one
+    already run reuses its namespace, with its own copies of the
+    functions, unless it keeps state of its own there (mutable values,
+    including functions' default arguments, or functions assigning
+    globals).
+
+    A relative cache_dir is taken from the working directory as of
+    when the holder is made; loaders pass their own (see
+    XMLGameLoader.new_funcholder)."""
+
+    def __init__(self, cache_dir=CACHE_DIR):
         self.files = {}
         self.cache = {}
+        self.cache_dir = os.path.abspath(cache_dir) if cache_dir is not None else None
+
+        self.compiled = {} # key -> (code object, source hash), in the order they ran
+        self.sources = {} # key -> source of the fragment run under it, when known
+
+        self._namespaces = {} # source hash -> (code object, namespace, functions) of a shareable fragment
 
     def set(self, key, code, override: bool = False, linepad: int = 0):
+        """Sets the source of a fragment. If override, it replaces the
+        one already run under the key, which is then run again on the
+        next get; unless it is the same source, in which case the
+        functions it made are kept."""
         if key in self.files and not override:
             return False
 
+        source = b'\n' * linepad + textwrap.dedent(code).strip('\n').encode('utf-8')
+
         if override and key in self.cache:
-            assert key in self.files
+            if self.sources.get(key) == source:
+                self.files[key] = source
+                return False
+
             del self.cache[key]
 
-        self.files[key] = b'\n' * linepad + textwrap.dedent(code).strip('\n').encode('utf-8')
+        self.files[key] = source
 
         return True
 
@@ -29,33 +118,97 @@ class CodeHolder:
         if key in self.cache:
             return self.cache[key]
 
-        # Get symbols created in code embed
-        from . import namegen
+        source = self.files[key]
+        digest = hashlib.sha1(importlib.util.MAGIC_NUMBER + str(filename).encode('utf-8') + b'\0' + source).hexdigest()
+        shared = self._namespaces.get(digest)
 
-        mod = dict(globals())
-        mod['namegen'] = namegen
+        res = self.run(key, shared[0] if shared is not None else self._compile(source, filename, digest), digest)
+        self.sources[key] = source
+
+        return res
 
-        pre = dict(mod)
+    def run(self, key, compiled, digest=None):
+        """Runs an already compiled fragment as key, like get does once
+        it has compiled it. Fragments with the same digest (see get)
+        may share a namespace."""
+        shared = self._namespaces.get(digest) if digest is not None else None
 
-        # print('Loading code fragment: {}'.format(key))
-        compiled = compile(self.files[key], filename, 'exec')
-        exec(compiled, mod)
+        if shared is not None:
+            compiled, mod, funcs = shared
+            res = {}
 
-        # Fetch all functions
-        res = {k: v for k, v in mod.items() if hasattr(v, '__call__') and hasattr(v, '__name__') if k not in pre or pre[k] != v}
+            for k, v in funcs.items():
+                if isinstance(v, types.FunctionType) and v.__globals__ is mod:
+                    f = types.FunctionType(v.__code__, mod, v.__lookup_name__, v.__defaults__, v.__closure__)
+                    f.__kwdefaults__ = v.__kwdefaults__
+                    f.__dict__.update(v.__dict__)
+
+                    v = f
+
+                res[k] = v
+
+        else:
+            # Get symbols created in code embed
+            mod = _script_globals()
+            pre = dict(mod)
+
+            # print('Loading code fragment: {}'.format(key))
+            exec(compiled, mod)
+
+            # Fetch all functions
+            res = {k: v for k, v in mod.items() if hasattr(v, '__call__') and hasattr(v, '__name__') if k not in pre or pre[k] != v}
+
+            for v in res.values():
+                v.__lookup_name__ = v.__name__
+
+            if digest is not None and not _rebinds_globals(compiled) and all(_shareable(v) for k, v in mod.items() if k not in pre or pre[k] is not v):
+                self._namespaces[digest] = (compiled, mod, dict(res))
 
         for v in res.values():
-            v.__lookup_name__ = v.__name__
             v.__name__ = key.replace(' ', '_').replace('-', '.')
 
+        self.compiled[key] = (compiled, digest)
+        self.sources.pop(key, None)
         self.cache[key] = res
         return res
 
+    def _compile(self, source, filename, digest):
+        """Compiles a fragment, or loads it from the on-disk cache."""
+        path = None
+
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, '{}.code'.format(digest))
+
+            try:
+                with open(path, 'rb') as fp:
+                    return marshal.load(fp)
+
+            except (OSError, EOFError, ValueError, TypeError):
+                pass
+
+        compiled = compile(source, filename, 'exec')
+
+        if path is not None:
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+
+                with open(tmp, 'wb') as fp:
+                    marshal.dump(compiled, fp)
+
+                os.replace(tmp, path)
+
+            except OSError:
+                logging.debug("Could not cache compiled code in {}".format(self.cache_dir), exc_info=True)
+
+        return compiled
+
     def __delitem__(self, key):
         del self.files[key]
 
-    def quick(self, key, code, linepad: int = 0, filename: str = None):
-        self.set(key, code, linepad=linepad)
+    def quick(self, key, code, linepad: int = 0, filename: str = None, override: bool = False):
+        self.set(key, code, override=override, linepad=linepad)
         return self.get(key, filename)
 
     def deinit(self):
@@ -1,20 +1,20 @@
-try:
-    import simplejson as json
-
-except ImportError:
-    import json
-
 import trio
+import copy
 import logging
+import os
 import random
 import sys
 
+from types import MappingProxyType
+
 sys.modules['_elementtree'] = None
 
 import xml.etree.ElementTree as etree
 
-from . import namegen, player, embedcode
-from queue import Queue, Empty
+from xml.parsers import expat
+
+from . import namegen, player, embedcode, pathfinding, columns, tracing, rng, snapshot, journal
+from collections import deque
 
 
 
@@ -27,6 +27,43 @@ class LineTrackingParser(etree.XMLParser):
 
 idnum = 0 # The default ID counter.
 
+ID_ALPHABET = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+
+
+class IDAllocator(object):
+    """Hands out entity IDs that never collide within a world.
+
+    IDs keep their old shape (24 alphanumeric characters), but are
+    made of a random per-world prefix followed by a base 62 counter,
+    so allocating many of them costs no random draws and no lookups
+    beyond a check against already taken IDs (e.g. from a save)."""
+
+    def __init__(self, prefix=None, length=24, rng=random):
+        self.prefix = prefix or ''.join(rng.choice(ID_ALPHABET) for _ in range(length // 2))
+        self.width = length - len(self.prefix)
+        self.counter = 0
+
+    def allocate(self, count=1, taken=()):
+        res = []
+
+        while len(res) < count:
+            n = self.counter
+            self.counter += 1
+
+            digits = []
+
+            for _ in range(self.width):
+                n, r = divmod(n, 62)
+                digits.append(ID_ALPHABET[r])
+
+            eid = self.prefix + ''.join(reversed(digits))
+
+            if eid not in taken:
+                res.append(eid)
+
+        return res
+
+
 
 # Broadcast levels
 BCAST_VERBOSE = -2
@@ -58,6 +95,7 @@ class EntityType(object):
         self.functions = dict(functions)
         self.systems = list(systems)
         self.default_attr = dict(default_entity_attr)
+        self.filename = None # the file it was loaded from, if any
 
         for k, v in variants.items():
             variants[k]['flags'] = set(v['flags'])
@@ -77,29 +115,73 @@ class EntityType(object):
         if not id:
             idnum += 1
 
+        self.lookup = {}
+        self.compile_variants()
+
+    def compile_variants(self):
+        """(Re)builds the attribute lookup table of every variant.
+
+        Must be called again after changing any variant's 'attr' or
+        'flags', since entities read their statics from these tables
+        rather than from the variant dicts themselves."""
+        self.lookup = {}
+        self.templates = {}
+
+        for vid in self.variants:
+            self.compile_variant(vid)
+
+    def compile_variant(self, vid):
+        """Folds a variant's flags and static attributes into a single
+        frozen table. Statics win over flags, unless they are None."""
+        v = self.variants[vid]
+        table = dict.fromkeys(v['flags'], True)
+
+        for k, val in v['attr'].items():
+            if val is not None:
+                table[k] = val
+
+        self.lookup[vid] = MappingProxyType(table)
+
+        attr = dict(self.default_attr)
+        attr.update(v['default'])
+
+        self.templates[vid] = (attr, tuple(k for k, val in attr.items() if isinstance(val, (list, dict, set))))
+
+        return self.lookup[vid]
+
+    def new_attr(self, variant, extra_attr=None):
+        """Builds a fresh attribute dict for a new entity of the given
+        variant from its precomputed template. Mutable defaults (like
+        friend lists and inventories) get their own copy per entity."""
+        template, mutable = self.templates[variant]
+        attr = dict(template)
+
+        for k in mutable:
+            attr[k] = copy.copy(attr[k])
+
+        if extra_attr:
+            attr.update(extra_attr)
+
+        return attr
+
     def __str__(self):
         return self.name
 
     def instantiate(self, world, place, variant, name=None, extra_attr={}):
-        """Creates an entity in its default state and returns it."""
+        """Creates an entity in its default state and returns it.
+        The entity is not added to the world; see GameWorld.spawn_many
+        to create and add many entities at once."""
 
         if isinstance(variant, dict):
             variant = variant['id']
 
-        attr = dict(self.default_attr)
-
-        for k, v in self.variants[variant]['default'].items():
-            attr[k] = v
-
-        for k, v in extra_attr.items():
-            attr[k] = v
-
-        id = ''.join([random.choice('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789') for _ in range(24)])
+        id = world.ids.allocate(1, world.entities)[0]
 
-        while world.from_id(id):
-            id = ''.join([random.choice('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789') for _ in range(24)])
+        if not name:
+            names = world.rng.names
+            name = namegen.generate_name(names.randint(6, 15), rng=names)
 
-        return [id, self.id, name or namegen.generate_name(random.randint(6, 15)), place, variant, attr]
+        return [id, self.id, name, place, variant, self.new_attr(variant, extra_attr)]
 
     def call(self, func, entity, *args, **kwargs):
         if entity is None:
@@ -107,19 +189,175 @@ class EntityType(object):
 
         return self.functions[func](entity, *args, **kwargs)
 
+    def update_from(self, other):
+        """Takes over the definition of another entity type, like this
+        one reloaded from its changed file, staying the same instance
+        for whatever refers to it.
+
+        Keys added to variants at runtime are carried over to their new
+        definitions, and variants the new definition lacks are kept for
+        entities still using them."""
+        variants = dict(self.variants)
+
+        for vid, v in other.variants.items():
+            for k, val in variants.get(vid, {}).items():
+                v.setdefault(k, val)
+
+            variants[vid] = v
+
+        self.name = other.name
+        self.base_attributes = other.base_attributes
+        self.variants = variants
+        self.functions = other.functions
+        self.systems = other.systems
+        self.default_attr = other.default_attr
+        self.filename = other.filename or self.filename
+
+        self.compile_variants()
+
+    def player_variants(self):
+        """IDs of the variants players can join as."""
+        return [k for k, v in self.variants.items() if v['attr'].get('isPlayer') or 'isPlayer' in v['flags']]
+
+class EntityTypeStub(object):
+    """What a world knows of an entity type it hasn't loaded yet: enough
+    to list it, to pick it for new players, and to tell which item types
+    it defines. See EntityTypeTable."""
+
+    def __init__(self, filename, name, id, player_variants=(), items=(), sources=()):
+        self.filename = filename
+        self.name = name
+        self.id = id
+        self.player_variants = list(player_variants)
+        self.items = list(items)
+        self.sources = list(sources) # files it is loaded from: its own, libraries, systems
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return '<EntityTypeStub {} ({})>'.format(self.id, self.filename)
+
+class EntityTypeTable(dict):
+    """Entity type ID -> EntityType, as GameWorld.etypes.
+
+    Entity types may also be added as stubs (see add_stub), which load,
+    through the table's loader, the first time they are looked up or
+    one of their item types is asked for (see GameWorld.find_item).
+    Membership tests and get cover stubs too; iterating, like len, only
+    goes over the types loaded so far.
+
+    loader gets the stub and returns the EntityType, adding its item
+    types to the world itself."""
+
+    def __init__(self, etypes=(), loader=None):
+        super().__init__(etypes)
+
+        self.loader = loader
+        self.stubs = {} # ID -> EntityTypeStub, in the order they were added, loaded or not
+        self.pending = {} # ordered set of stubbed IDs not loaded yet
+        self.item_owners = {} # item type name -> ID of the last stub defining it
+
+    def add_stub(self, stub):
+        self.stubs[stub.id] = stub
+
+        if not dict.__contains__(self, stub.id):
+            self.pending[stub.id] = None
+
+        for name in stub.items:
+            self.item_owners[name] = stub.id
+
+    def load(self, id):
+        """Loads a stubbed entity type now, and returns it."""
+        if id not in self.pending:
+            return dict.__getitem__(self, id)
+
+        del self.pending[id]
+
+        logging.debug("Loading Entity Type {} on demand...".format(id))
+
+        try:
+            etype = self.loader(self.stubs[id])
+
+        except BaseException:
+            self.pending[id] = None
+            raise
+
+        self[id] = etype
+
+        return etype
+
+    def load_all(self):
+        for id in tuple(self.pending):
+            self.load(id)
+
+    def provide_item(self, name):
+        """Makes sure the entity type whose definition of an item type
+        counts is loaded."""
+        owner = self.item_owners.get(name)
+
+        if owner in self.pending:
+            self.load(owner)
+
+    def player_variants(self):
+        """Entity type ID -> IDs of the variants players can join as,
+        for every entity type that has some, loaded or not; stubbed
+        types first, in the order they were added."""
+        res = {}
+
+        for id, stub in self.stubs.items():
+            variants = stub.player_variants if id in self.pending else dict.__getitem__(self, id).player_variants()
+
+            if variants:
+                res[id] = variants
+
+        for id, etype in self.items():
+            if id not in self.stubs:
+                variants = etype.player_variants()
+
+                if variants:
+                    res[id] = variants
+
+        return res
+
+    def __missing__(self, id):
+        if id in self.pending:
+            return self.load(id)
+
+        raise KeyError(id)
+
+    def __contains__(self, id):
+        return dict.__contains__(self, id) or id in self.pending
+
+    def get(self, id, default=None):
+        try:
+            return self[id]
+
+        except KeyError:
+            return default
+
 class LoadedEntity(object):
+    """A live view over an entity list. GameWorld hands out exactly one
+    of these per entity (see GameWorld.from_ent), so flags like
+    despawned are shared by every reference to the same entity."""
+
+    __slots__ = ('world', 'spl', 'despawned', '_etype', '_table')
+
     def __init__(self, world, spl):
         self.world = world
         self.spl = spl
         self.despawned = False
 
+        self._etype = world.etypes[spl[1]]
+        self._table = self._etype.lookup[spl[4]]
+
     @property
     def id(self):
         return self.spl[0]
 
     @property
     def type(self):
-        return self.world.etypes[self.spl[1]]
+        return self._etype
 
     @property
     def name(self):
@@ -127,7 +365,7 @@ class LoadedEntity(object):
 
     @name.setter
     def name(self, val):
-        self.spl[2] = val
+        self.world.rename_entity(self.spl, val)
 
     @property
     def place(self):
@@ -135,11 +373,15 @@ class LoadedEntity(object):
 
     @place.setter
     def place(self, val):
+        old = self.spl[3]
         self.spl[3] = val
 
+        if old != val:
+            self.world.reindex_place(self.spl[0], old, val)
+
     @property
     def variant(self):
-        return self.type.variants[self.spl[4]]
+        return self._etype.variants[self.spl[4]]
 
     @variant.setter
     def variant(self, variant):
@@ -147,6 +389,10 @@ class LoadedEntity(object):
             variant = variant['id']
 
         self.spl[4] = variant
+        self._table = self._etype.lookup[variant]
+
+        if self.world.journal is not None:
+            self.world.journal.touch(self.spl[0])
 
     @property
     def attr(self):
@@ -164,14 +410,24 @@ class LoadedEntity(object):
         if self.despawned:
             return
 
+        # Untouched variant defaults go back to the type-wide default,
+        # if any, so e.g. a kid growing up does not lose its accuracy.
+        reset = set()
+
         for k, v in self.variant['default'].items():
             if k in self.attr and self.attr[k] == v:
-                self.attr.pop(k)
+                reset.add(k)
+
+                if k in self.type.default_attr:
+                    self.attr[k] = copy.copy(self.type.default_attr[k])
+
+                else:
+                    self.attr.pop(k)
 
         self.variant = self.type.variants[variant]
 
         for k, v in self.variant['default'].items():
-            if k not in self.attr:
+            if k not in self.attr or k in reset:
                 self.attr[k] = v
 
     def __deitem__(self, key):
@@ -186,6 +442,9 @@ class LoadedEntity(object):
 
         res = self.attr.pop(key, default)
 
+        if self.world.journal is not None:
+            self.world.journal.touch(self.spl[0])
+
         return res
 
     def __setitem__(self, key, val):
@@ -194,6 +453,9 @@ class LoadedEntity(object):
 
         self.attr[key] = val
 
+        if self.world.journal is not None:
+            self.world.journal.touch(self.spl[0])
+
     def pointer(self, key):
         if not self[key]:
             return None
@@ -203,13 +465,16 @@ class LoadedEntity(object):
     def pointer_set(self, key, ent):
         if not ent:
             self[key] = None
+            return
 
         self[key] = ent.id
 
     def pointer_list(self, key):
         for a in self[key]:
-            if a and a in self.world.entities:
-                yield self.world.from_id(a)
+            e = (self.world.from_id(a) if a else None)
+
+            if e is not None:
+                yield e
 
     def spawn(self, type=None, variant=None, place=None, extra_attr=None, return_loaded=True):
         if type is None:
@@ -222,34 +487,27 @@ class LoadedEntity(object):
             if not type:
                 raise ValueError("No such entity type: {}".format(_a))
 
-        if variant is None:
-            variant = random.choice(tuple(type.variants.keys()))
-
         if place is None:
             place = self.place
 
-        if extra_attr is None:
-            extra_attr = {}
-
-        e = type.instantiate(self.world, place, variant, extra_attr)
-
-        self.world.add_entity(e)
-        self.world.unload_all()
+        e = self.world.spawn_many(type, place, variant, 1, extra_attr)[0]
 
         if return_loaded:
-            return self.world.from_ent(e)
+            return e
 
         else:
-            return e[0]
+            return e.id
 
     def of(self, type):
         return self.etype.id == type
 
     def set_name(self, name):
+        """Renames the entity. While the world is ticking, the new
+        name only takes effect once the tick is over."""
         if self.despawned:
             return
 
-        self.name = name
+        self.world.defer('rename', self.spl, name)
 
     def __repr__(self):
         return 'Entity<{} {}>'.format(self.variant['name'], repr(self.name))
@@ -258,22 +516,23 @@ class LoadedEntity(object):
         if self.despawned:
             return None
 
-        a = self.attr.get(key)
-        b = (a if a is not None else self.variant['attr'].get(key))
+        a = self.spl[5].get(key)
 
-        return (b if b is not None else (True if key in self.variant['flags'] else None))
+        if a is not None:
+            return a
+
+        return self._table.get(key)
 
     def call(self, func, *args, **kwargs):
         if self.despawned:
             return
 
-        fspace = getattr(self.type.functions[func], '__funcspace', "")
+        tracer = self.world.tracer
 
-        if fspace != "":
-            fspace = "<" + fspace + ">"
+        if tracer is not None:
+            return tracer.call(self, func, args, kwargs)
 
-        logging.debug("ENTITY CALL: {}('{}', '{}', '{}').{}{}({})".format(self.type.id, self.name, self.variant['name'], self.place, func, fspace, ', '.join([(repr(a.name) if isinstance(a, LoadedEntity) else (repr(a.entity.name) if isinstance(a, player.PlayerInterface) else repr(a))) for a in args])))
-        return self.type.call(func, self, *args, **kwargs)
+        return self._etype.functions[func](self, *args, **kwargs)
 
     def event(self, evt, *args, **kwargs):
         if self.despawned:
@@ -312,166 +571,887 @@ class LoadedEntity(object):
     def __str__(self):
         return "{} the {} from {}".format(self.get_name(), self.variant['name'], self.place)
 
+def _discard(index, key, item):
+    """Removes item from the ordered set index[key], dropping
+    the set once empty."""
+    bucket = index.get(key)
+
+    if bucket is not None:
+        bucket.pop(item, None)
+
+        if not bucket:
+            del index[key]
+
 class GameWorld(object):
-    def __init__(self, etypes=(), paths=(), places=(), entities=(), item_types=(), beginning=None):
-        self.etypes = dict(etypes)
-        self.paths = list(paths)
+    def __init__(self, etypes=(), paths=(), places=(), entities=(), item_types=(), beginning=None, seed=None):
+        self.rng = rng.RandomService(seed)
+        self.etypes = EntityTypeTable(etypes)
+        self._paths = []
+        self.adjacency = {} # place name -> {neighbour place name: number of paths joining both}
+        self.pathfinder = pathfinding.Pathfinder(self)
         self.places = dict(places)
         self.entities = dict(entities)
-        
+
+        self.journal = None # journal.Journal, see enable_journal
+
+        self._ticking = False
+        self._deferred = []
+        self._deferred_handlers = {
+            'spawn': self._add_entities_now,
+            'rename': self.rename_entity,
+            'add_path': self._add_path_now,
+            'remove_path': self._remove_path_now,
+        }
+
+        self.player_ids = {} # ordered set of player entity IDs
+
+        self.columns = None # optional columns.ColumnStore, see enable_columns
+        self.bulk_systems = {}
+
+        self.ids = IDAllocator(rng=self.rng.spawning)
         self.entity_names = {}
-        
-        for e in self:
-            self.entity_names.setdefault(e[2], set()).add(e[0])
-        
+        self.place_index = {} # place name -> ordered set (dict) of entity IDs
+        self._loaded = {} # entity ID -> its LoadedEntity, see from_ent
+
+        # Broadcast subscriptions, see add_broadcast_channel.
+        self.broadcast_channels = set()
+        self._global_channels = {} # ordered set of channels hearing everything
+        self._place_channels = {} # place name -> ordered set of channels
+        self._follow_channels = {} # entity ID -> ordered set of channels following it
+        self._follow_index = {} # place name -> ordered set of channels following someone there
+
+        self.rebuild_indexes()
+
         self.item_types = dict(item_types)
         self.beginning = beginning
 
-        self.message_queue = Queue()
-        self.broadcast_channels = set()
+        for p in paths:
+            self.add_path(p)
+
+        self.tracer = None # tracing.Tracer, see enable_tracing
+
+        # name -> (function returning extra state to snapshot, function
+        # restoring it), for state kept outside the world; see snapshot.py
+        self.snapshot_providers = {}
+
+        # Broadcasts travel to _broadcast_loop over a bounded trio memory
+        # channel. What doesn't fit waits in the backlog, which the next
+        # tick drains first, so a slow chat slows the game down instead
+        # of piling up messages (see flush_broadcasts). Past
+        # broadcast_backlog_limit within a single tick, the oldest are
+        # dropped (counted in broadcasts_dropped, and logged).
+        self.broadcast_capacity = 256
+        self.broadcast_backlog_limit = 4096
+        self.broadcasts_dropped = 0
+        self._drop_warned = None # tick whose drops were logged already
+
+        self._bus_send, self._bus_receive = trio.open_memory_channel(self.broadcast_capacity)
+        self._bus_backlog = deque()
+        self._bus_listening = 0
+        self._bus_nursery = None # runs outboxes, see _start_outbox
+        self._min_broadcast_level = float('inf')
+
         self.global_systems = []
 
         self._last_tick_removals = set()
 
         self._queued_removals = None
 
-    def dumps(self, yaml=True):
-        save = {
-            'entities': self.entities,
-            'places': self.places
-        }
+        # Level of detail: when lod_radius is set, places farther than
+        # that many paths away from every player go dormant; their
+        # entities are skipped by ticks and caught up once woken.
+        self.lod_radius = None
+        self.regrowth_rate = 0.05 # per tick, as a fraction of a place's initial stock
+        self.tick_count = 0
+        self.dormant = {} # place name -> tick it went dormant at
+        self._asleep_since = {} # entity ID -> tick it entered a dormant place at
+
+    def dumps(self, compress=True):
+        """Returns a binary snapshot of the whole world state; see
+        snapshot.py."""
+        return snapshot.dumps(self, compress)
+
+    def loads(self, data):
+        """Replaces the world state with a snapshot made by dumps."""
+        snapshot.loads(self, data)
+
+    def enable_columns(self, spec=None, systems=tuple(columns.BULK_SYSTEMS)):
+        """Turns on the named vectorized bulk systems, which take over
+        the matching parts of creature_tick, gathering the attributes
+        named in spec (by default columns.CREATURE_COLUMNS) into NumPy
+        arrays; see columns.py.
+
+        Experimental: so far, whole ticks run no faster than without it
+        (try benchmark.py --columns), which is why make_game and the
+        config don't offer it. Requires NumPy."""
+        self.columns = columns.ColumnStore(spec or columns.CREATURE_COLUMNS, self.rng.ai.numpy())
+
+        for name in systems:
+            self.bulk_systems[name] = columns.BULK_SYSTEMS[name]
+            self.columns.queued[name] = []
+
+    def enable_tracing(self, tracer=None, **kwargs):
+        """Starts recording entity calls into a tracing.Tracer, made
+        from kwargs unless given, and returns it. Can be called again
+        at any time to swap filters."""
+        if tracer is None:
+            tracer = tracing.Tracer(**kwargs)
+
+        self.tracer = tracer
+
+        return tracer
+
+    def disable_tracing(self):
+        tracer = self.tracer
+        self.tracer = None
+
+        return tracer
+
+    def enable_journal(self, filename, snapshot_file, **kwargs):
+        """Starts journaling every change to the world into filename,
+        compacted into snapshot_file from time to time, and returns the
+        journal.Journal; see journal.py. Use journal.recover first to
+        pick up from an earlier journal."""
+        self.disable_journal()
+        self.journal = journal.Journal(self, filename, snapshot_file, **kwargs)
+
+        return self.journal
+
+    def disable_journal(self):
+        """Stops journaling, once everything journaled so far is
+        written."""
+        j = self.journal
+        self.journal = None
+
+        if j is not None:
+            j.close()
+
+        return j
+
+    def bulk_queue(self, name, entity):
+        """Queues an entity for a bulk system's next pass, if that
+        system is enabled; returns whether it was, in which case
+        scripts must skip their scalar version of the update."""
+        queue = self.columns.queued.get(name) if self.columns is not None else None
+
+        if queue is None:
+            return False
+
+        queue.append(entity)
+        return True
+
+    def rebuild_indexes(self):
+        """Rebuilds the name and place indexes from scratch.
+
+        Only needed when self.entities is replaced wholesale; every
+        other change keeps the indexes up to date by itself."""
+        self.entity_names = {}
+        self.place_index = {}
+        self._loaded = {}
+        self.player_ids = {}
 
-        if yaml:
-            return yaml.dump(save)
+        for e in self.entities.values():
+            self.entity_names.setdefault(e[2], {})[e[0]] = None
+            self.place_index.setdefault(e[3], {})[e[0]] = None
 
-        return json.dumps(save)
+            if self.etypes[e[1]].lookup[e[4]].get('isPlayer') or e[5].get('isPlayer'):
+                self.player_ids[e[0]] = None
 
-    def loads(self, data, yaml=True):
-        if yaml:
-            data = yaml.load(data)
+        self.rebuild_follow_index()
 
-        else:
-            data = json.loads(data)
+    def rebuild_follow_index(self):
+        """Rebuilds the index of where followed entities stand (see
+        add_broadcast_channel)."""
+        self._follow_index = {}
+
+        for eid, chans in self._follow_channels.items():
+            e = self.entities.get(eid)
+
+            if e is not None:
+                self._follow_index.setdefault(e[3], {}).update(chans)
+
+    @property
+    def paths(self):
+        """A read-only view of every path, each a set of place names.
+        Use add_path and remove_path to change it, so that the
+        adjacency graph stays in sync."""
+        return tuple(self._paths)
+
+    def add_path(self, ends):
+        return self.defer('add_path', ends)
+
+    def remove_path(self, ends):
+        return self.defer('remove_path', ends)
+
+    def _add_path_now(self, ends):
+        ordered = tuple(dict.fromkeys(ends)) # declaration order, unlike the set
+        ends = set(ordered)
+        self._paths.append(ends)
+
+        for a in ordered:
+            neigh = self.adjacency.setdefault(a, {})
+
+            for b in ordered:
+                if b != a:
+                    neigh[b] = neigh.get(b, 0) + 1
+
+        self.pathfinder.invalidate()
+
+        if self.journal is not None:
+            self.journal.paths_changed = True
+
+        return ends
+
+    def _remove_path_now(self, ends):
+        ends = set(ends)
+
+        if ends not in self._paths:
+            return False
+
+        self._paths.remove(ends)
+
+        for a in ends:
+            neigh = self.adjacency[a]
+
+            for b in ends:
+                if b != a:
+                    neigh[b] -= 1
 
-        self.entities = data['entities']
-        self.places = data['places']
+                    if neigh[b] <= 0:
+                        del neigh[b]
+
+            if not neigh:
+                del self.adjacency[a]
+
+        self.pathfinder.invalidate()
+
+        if self.journal is not None:
+            self.journal.paths_changed = True
+
+        return True
+
+    def neighbors(self, place):
+        """Returns a tuple of every place directly reachable
+        from the given place, in path declaration order."""
+        return tuple(self.adjacency.get(place, ()))
+
+    def is_adjacent(self, a, b):
+        return b in self.adjacency.get(a, ())
+
+    def add_broadcast_channel(self, level, *channels, name=None, follow=None, places=None, below=None):
+        """Subscribes channels to broadcasts of at least the given level
+        (and below the level below, if given).
+
+        By default, a channel hears everything. With follow (an entity
+        or entity ID), it only hears broadcasts made in that entity's
+        place, wherever it goes; with places, only those made in any of
+        the given places. Either way, broadcasts made nowhere in
+        particular don't reach it."""
+        if isinstance(places, str):
+            places = {places}
+
+        follow = getattr(follow, 'id', follow)
 
-    def add_broadcast_channel(self, level, *channels, name=None):
         for c in channels:
             setattr(c, '_level', level)
+            setattr(c, '_below', below)
 
-        if name:
-            for c in channels:
+            if name:
                 setattr(c, '__chan_name', name)
 
-        self.broadcast_channels |= set(channels)
+            self._unsubscribe(c)
+            self.broadcast_channels.add(c)
+            self._start_outbox(c)
+
+            if follow is not None:
+                setattr(c, '_follow', follow)
+                self._follow_channels.setdefault(follow, {})[c] = None
+
+                e = self.entities.get(follow)
+
+                if e is not None:
+                    self._follow_index.setdefault(e[3], {})[c] = None
+
+            elif places is not None:
+                setattr(c, '_places', tuple(places))
+
+                for p in places:
+                    self._place_channels.setdefault(p, {})[c] = None
+
+            else:
+                self._global_channels[c] = None
+
+        self._update_broadcast_level()
 
     def remove_broadcast_channel(self, name):
         for bc in set(self.broadcast_channels):
             bcname = getattr(bc, '__chan_name', None)
 
-            if bcname and bcname == name and bc in self.broadcast_channels:
-                self.broadcast_channels.remove(bc)
+            if bcname and bcname == name:
+                self._unsubscribe(bc)
+
+        self._update_broadcast_level()
+
+    def _unsubscribe(self, c):
+        if c not in self.broadcast_channels:
+            return
+
+        self.broadcast_channels.discard(c)
+        self._global_channels.pop(c, None)
+
+        if hasattr(c, 'close'):
+            c.close()
+
+        for p in getattr(c, '_places', ()):
+            _discard(self._place_channels, p, c)
+
+        follow = getattr(c, '_follow', None)
+
+        if follow is not None:
+            _discard(self._follow_channels, follow, c)
+
+            e = self.entities.get(follow)
+
+            if e is not None:
+                _discard(self._follow_index, e[3], c)
+
+        c._places = ()
+        c._follow = None
+
+    def _move_followers(self, eid, old, new):
+        chans = self._follow_channels[eid]
+
+        if old is not None:
+            for c in chans:
+                _discard(self._follow_index, old, c)
+
+        if new is not None:
+            self._follow_index.setdefault(new, {}).update(chans)
+
+    def subscribers(self, level, place=None):
+        """Returns the channels that should hear a broadcast of the
+        given level made in the given places (a set, or None)."""
+        res = {}
+
+        def _add(chans):
+            for c in chans:
+                if level >= getattr(c, '_level', level) and (getattr(c, '_below', None) is None or level < c._below):
+                    res[c] = None
+
+        _add(self._global_channels)
+
+        if place:
+            for p in place:
+                _add(self._place_channels.get(p, ()))
+                _add(self._follow_index.get(p, ()))
+
+        return res
+
+    def _update_broadcast_level(self):
+        self._min_broadcast_level = min((getattr(c, '_level', float('-inf')) for c in self.broadcast_channels), default=float('inf'))
 
     def broadcast(self, level, *message, place=None, to=None):
+        # Nobody would hear it; don't even bother rendering it.
+        if level < self._min_broadcast_level and (to is None or level < getattr(to, '_level', float('-inf'))):
+            return
+
         if isinstance(place, str):
             place = {place}
 
-        self.message_queue.put((level, message, place, to))
+        item = (level, message, place, to, self.tick_count)
 
-    async def _broadcast_loop(self):
-        while True:
+        if not self._bus_backlog:
             try:
-                level, message, place, to = self.message_queue.get_nowait()
+                self._bus_send.send_nowait(item)
+                return
 
-            except Empty:
-                await trio.sleep(0.3)
-                continue
+            except trio.WouldBlock:
+                pass
 
-            m = ""
+        if len(self._bus_backlog) >= self.broadcast_backlog_limit:
+            # The backlog only drains between ticks (see tick), so a
+            # single tick broadcasting more than this, or nothing
+            # draining the bus at all, loses the oldest messages.
+            self._bus_backlog.popleft()
+            self.broadcasts_dropped += 1
 
-            for node in message:
-                m += str(node)
+            if self._drop_warned != self.tick_count:
+                self._drop_warned = self.tick_count
+                logging.warning("Broadcast backlog full ({} messages) during tick {}; dropping the oldest. {} dropped so far.".format(self.broadcast_backlog_limit, self.tick_count, self.broadcasts_dropped))
 
-            logging.debug("BROADCAST: PLACE={} LVL={} MSG={}".format(repr(place), level, repr(m)))
+        self._bus_backlog.append(item)
 
-            can_wait = [False]
+    def _refill_broadcasts(self):
+        while self._bus_backlog:
+            try:
+                self._bus_send.send_nowait(self._bus_backlog[0])
 
-            async def broadcast_to(channel):
-                if not hasattr(channel, '_level') or level >= channel._level:
-                    can_wait[0] = await channel(m, place, level) or can_wait[0]
+            except trio.WouldBlock:
+                return
 
-            if to:
-                await broadcast_to(to)
+            self._bus_backlog.popleft()
 
-            for b in self.broadcast_channels:
-                await broadcast_to(b)
+    async def flush_broadcasts(self):
+        """Waits until every pending broadcast fits in the bus. Does
+        nothing unless a _broadcast_loop is running to drain it."""
+        while self._bus_backlog and self._bus_listening:
+            await self._bus_send.send(self._bus_backlog[0])
+            self._bus_backlog.popleft()
 
-            if can_wait[0]:
-                await trio.sleep(0.5)
+    def _start_outbox(self, c):
+        # Outboxes (see outbox.py) batch and pace their own sending,
+        # in a task of their own.
+        if self._bus_nursery is not None and hasattr(c, 'run') and not c.running:
+            self._bus_nursery.start_soon(c.run)
 
-            else:
-                await trio.sleep(0)
+    async def _broadcast_loop(self):
+        self._bus_listening += 1
+
+        try:
+            async with trio.open_nursery() as nursery:
+                self._bus_nursery = nursery
+
+                for c in tuple(self.broadcast_channels):
+                    self._start_outbox(c)
+
+                async for level, message, place, to, tick in self._bus_receive:
+                    self._refill_broadcasts()
+                    await self._deliver(level, message, place, to, tick)
+
+                nursery.cancel_scope.cancel()
+
+        finally:
+            self._bus_nursery = None
+            self._bus_listening -= 1
+
+    async def _deliver(self, level, message, place, to, tick):
+        m = None
+        can_wait = False
+
+        targets = self.subscribers(level, place)
+
+        if to and (not hasattr(to, '_level') or level >= to._level):
+            targets = dict.fromkeys((to, *targets))
+
+        for b in targets:
+            if b is not to and b not in self.broadcast_channels: # (may leave mid-delivery)
+                continue
+
+            put = getattr(b, 'put', None)
+
+            if put is not None:
+                put(message, place, level, tick)
+                continue
+
+            if m is None:
+                m = ''.join(str(node) for node in message)
+
+                if logging.root.isEnabledFor(logging.DEBUG):
+                    logging.debug("BROADCAST: PLACE={} LVL={} MSG={}".format(repr(place), level, repr(m)))
+
+            can_wait = await b(m, place, level) or can_wait
+
+        if can_wait:
+            await trio.sleep(0.5)
 
     async def tick(self):
-        perc = 0
+        await self.flush_broadcasts()
+
+        active = self.update_lod()
 
-        self._queued_removals = set()
+        self._queued_removals = {}
+        self._ticking = True
+        self.pathfinder.invalidate()
 
-        for eid, e in self.entities.items():
-            if eid not in self._queued_removals:
-                en = LoadedEntity(self, e)
+        # Iterate over a snapshot; entities spawned during the tick
+        # only join the world once it is over (see defer).
+        if active is None:
+            snapshot = tuple(self.entities.values())
+
+        else:
+            # (in place order, not set order, so ticks can be replayed)
+            snapshot = tuple(self.entities[eid] for p in self.places if p in active for eid in self.place_index.get(p, ()))
+
+        for e in snapshot:
+            eid = e[0]
+
+            if eid not in self._queued_removals and eid in self.entities:
+                en = self.from_ent(e)
 
                 if 'tick' in en.type.functions:
                     try:
                         en.call('tick')
 
                     except BaseException:
-                        print(repr(en), str(en))
+                        logging.exception("Entity {} ({}) failed to tick".format(repr(en), en.id))
                         raise
 
                 en.event('tick')
 
-            perc += 1
+        if self.bulk_systems:
+            self.columns.run(self)
 
-            logging.debug("TICK: {:.2f}% complete.".format(100.0 * perc / len(self.entities)))
+        logging.debug("TICK: {} entities ticked.".format(len(snapshot)))
 
         self.broadcast(4, '<Tick finished.>')
         self.resolve_removals()
 
         self._queued_removals = None
+        self._ticking = False
+        self.tick_count += 1
+
+        self.apply_deferred()
+
+        if self.journal is not None:
+            self.journal.commit()
+
+    def update_lod(self):
+        """Puts places far from every player to sleep and wakes up
+        (catching up) the ones players came near again. Returns the
+        set of awake places, or None if level of detail is disabled."""
+        if self.lod_radius is None:
+            if self.dormant:
+                for p in tuple(self.dormant):
+                    self.wake_place(p)
+
+            return None
+
+        active = set()
+        frontier = set()
+
+        for eid in self.player_ids:
+            e = self.entities.get(eid)
+
+            if e is not None:
+                frontier.add(e[3])
+
+        for _ in range(self.lod_radius + 1):
+            active |= frontier
+            frontier = {n for p in frontier for n in self.neighbors(p)} - active
+
+        for p in self.places:
+            if p not in active and p not in self.dormant:
+                self.dormant[p] = self.tick_count
+
+        for p in tuple(self.dormant):
+            if p in active:
+                self.wake_place(p)
+
+        return active
+
+    def wake_place(self, place):
+        """Brings a dormant place back up to date: its items regrow,
+        and each entity's catch_up function runs with the number of
+        ticks it spent asleep."""
+        since = self.dormant.pop(place, None)
+
+        if since is None:
+            return
+
+        elapsed = self.tick_count - since
+        p = self.places.get(place)
+
+        if p is not None and elapsed > 0:
+            if self.journal is not None:
+                self.journal.touch_place(place)
+
+            for item, stock in p.get('stock', {}).items():
+                have = p['items'].get(item, 0)
+
+                if have < stock:
+                    p['items'][item] = min(stock, have + max(1, int(stock * self.regrowth_rate * elapsed)))
+
+        self._queued_removals = {}
+        self._ticking = True
+
+        for en in tuple(self.all_in_place(place)):
+            ticks = self.tick_count - self._asleep_since.pop(en.id, since)
+
+            if ticks > 0 and 'catch_up' in en.type.functions:
+                en.call('catch_up', ticks)
+
+        self.resolve_removals()
+
+        self._queued_removals = None
+        self._ticking = False
+
+        self.apply_deferred()
+
+    def defer(self, kind, *args):
+        """Applies a structural change to the world: right away
+        outside of a tick, or at the end of the current tick otherwise.
+
+        Kinds are 'spawn' (a list of entity lists and whether to
+        call their init functions), 'rename' (an
+        entity list and its new name), 'add_path' and 'remove_path'
+        (the ends of a path)."""
+        if self._ticking:
+            self._deferred.append((kind, args))
+            return None
+
+        return self._deferred_handlers[kind](*args)
+
+    def apply_deferred(self):
+        """Applies every change deferred during the last tick, in
+        order, batching consecutive spawns into a single add."""
+        queue = self._deferred
+        self._deferred = []
+
+        spawns = []
+        spawn_init = True
+
+        for kind, args in queue:
+            if kind == 'spawn' and (not spawns or args[1] == spawn_init):
+                spawns.extend(args[0])
+                spawn_init = args[1]
+                continue
+
+            if spawns:
+                self._add_entities_now(spawns, spawn_init)
+                spawns = []
+
+            if kind == 'spawn':
+                spawns.extend(args[0])
+                spawn_init = args[1]
+                continue
+
+            self._deferred_handlers[kind](*args)
+
+        if spawns:
+            self._add_entities_now(spawns, spawn_init)
+
+    def rename_entity(self, e, name):
+        """Renames an entity list right away, keeping the name
+        index in sync."""
+        old = e[2]
+        e[2] = name
+
+        if e[0] not in self.entities or old == name:
+            return
+
+        if self.journal is not None:
+            self.journal.touch(e[0])
+
+        names = self.entity_names.get(old)
+
+        if names is not None:
+            names.pop(e[0], None)
+
+            if not names:
+                del self.entity_names[old]
+
+        self.entity_names.setdefault(name, {})[e[0]] = None
+
+        if self.journal is not None:
+            self.journal.touch_index('entity_names', name)
 
     def queue_removal(self, eid):
-        self._queued_removals.add(eid)
+        self._queued_removals[eid] = None
 
     def resolve_removals(self):
         for qr in self._queued_removals:
             self._last_tick_removals.add(qr)
-            n = self.from_id(qr).name
+            self.remove_entity(qr)
+
+        self._queued_removals = {}
+
+    def remove_entity(self, eid):
+        """Removes an entity from the world right away, along with
+        its index entries. Prefer LoadedEntity.despawn while ticking."""
+        e = self.entities.pop(eid, None)
+
+        if e is None:
+            return
+
+        names = self.entity_names.get(e[2])
 
-            del self.entities[qr]
+        if names is not None:
+            names.pop(eid, None)
+
+            if not names:
+                del self.entity_names[e[2]]
+
+        self._unindex_place(eid, e[3])
+        self._loaded.pop(eid, None)
+
+        if self.journal is not None:
+            self.journal.remove(eid)
+
+        if eid in self._follow_channels:
+            self._move_followers(eid, e[3], None)
+        self.player_ids.pop(eid, None)
+        self._asleep_since.pop(eid, None)
+
+    def reindex_place(self, eid, old, new):
+        """Moves an entity ID between place index buckets. Called
+        by LoadedEntity whenever an entity's place changes."""
+        if eid not in self.entities:
+            return
 
-            self.entity_names[n].remove(qr)
+        self._unindex_place(eid, old)
+        self.place_index.setdefault(new, {})[eid] = None
 
-            if not self.entity_names[n]:
-                del self.entity_names[n]
+        if self.journal is not None:
+            self.journal.touch(eid)
+            self.journal.touch_index('place_index', new)
 
-        self._queued_removals = set()
+        if eid in self._follow_channels:
+            self._move_followers(eid, old, new)
+
+        if new in self.dormant:
+            self._asleep_since.setdefault(eid, self.tick_count)
+
+    def _unindex_place(self, eid, place):
+        bucket = self.place_index.get(place)
+
+        if bucket is not None:
+            bucket.pop(eid, None)
+
+            if not bucket:
+                del self.place_index[place]
 
     def add_entity(self, e):
-        ent = LoadedEntity(self, e)
+        return self.add_entities([e])[0]
+
+    def add_entities(self, es, init=True):
+        """Adds a batch of entity lists to the world, then calls the
+        init function of each (unless init is False, e.g. for entities
+        that already lived elsewhere). Returns their LoadedEntity
+        instances.
+
+        During a tick, the entities are only added (and initialized)
+        once the tick is over; until then, the returned instances work
+        but the entities can't be found through the world."""
+        if self._ticking:
+            es = list(es)
+            self.defer('spawn', es, init)
+
+            return [self._wrap(e) for e in es]
+
+        return self._add_entities_now(es, init)
+
+    def _wrap(self, e):
+        ent = self._loaded.get(e[0])
+
+        if ent is None or ent.spl is not e:
+            ent = self._loaded[e[0]] = LoadedEntity(self, e)
+
+        return ent
+
+    def _add_entities_now(self, es, init=True):
+        loaded = []
+        bucket = None
+        bucket_place = None
+
+        for e in es:
+            self.entities[e[0]] = e
+            self.entity_names.setdefault(e[2], {})[e[0]] = None
+
+            if bucket is None or e[3] != bucket_place:
+                bucket_place = e[3]
+                bucket = self.place_index.setdefault(bucket_place, {})
 
-        self.entities[ent.id] = e
-        self.entity_names.setdefault(ent.name, set()).add(ent.id)
+            bucket[e[0]] = None
 
-        if 'init' in self.etypes[e[1]].functions:
-            ent.call('init')
+            ent = self._wrap(e)
+            loaded.append(ent)
+
+            if ent['isPlayer']:
+                self.player_ids[e[0]] = None
+
+            if e[3] in self.dormant:
+                self._asleep_since[e[0]] = self.tick_count
+
+            if e[0] in self._follow_channels:
+                self._move_followers(e[0], None, e[3])
+
+            if self.journal is not None:
+                self.journal.touch(e[0])
+                self.journal.touch_index('entity_names', e[2])
+                self.journal.touch_index('place_index', e[3])
+
+        if init:
+            for ent in loaded:
+                if 'init' in ent.type.functions:
+                    ent.call('init')
+
+        return loaded
+
+    def spawn_many(self, etype, place, variants=None, count=1, extra_attr=None, names=None):
+        """Creates count new entities of an entity type at a place and
+        adds them to the world in one batch.
+
+        variants may be a variant ID, a ';'-separated list or sequence
+        of IDs to pick from at random, or None or '*' for any variant.
+        names, if given, must have one name per entity; otherwise names
+        are generated. Returns the new entities' LoadedEntity instances."""
+        if isinstance(etype, str):
+            _a = etype
+            etype = self.etypes.get(etype)
+
+            if etype is None:
+                raise ValueError("No such entity type: {}".format(_a))
+
+        if isinstance(variants, dict):
+            variants = variants['id']
+
+        if variants is None or variants == '*':
+            variants = tuple(etype.variants)
+
+        elif isinstance(variants, str):
+            variants = variants.split(';')
+
+        if names is not None and len(names) < count:
+            raise ValueError("spawn_many got {} names for {} entities!".format(len(names), count))
+
+        ids = self.ids.allocate(count, self.entities)
+        new = []
+
+        spawning = self.rng.spawning
+        naming = self.rng.names
+
+        for i, eid in enumerate(ids):
+            variant = (variants[0] if len(variants) == 1 else spawning.choice(variants))
+            name = (names[i] if names is not None else namegen.generate_name(naming.randint(6, 15), rng=naming))
+
+            new.append([eid, etype.id, name, place, variant, etype.new_attr(variant, extra_attr)])
+
+        return self.add_entities(new)
+
+    def replace_entity_type(self, etype):
+        """Swaps in a new definition for the entity type with the same
+        ID (see EntityType.update_from), or adds it if there is none.
+        Entities keep their state. Must be called between ticks.
+        Returns the entity type in use."""
+        old = dict.get(self.etypes, etype.id)
+
+        if old is None:
+            self.etypes.pending.pop(etype.id, None)
+            self.etypes[etype.id] = etype
+
+            return etype
+
+        old.update_from(etype)
+
+        for le in self._loaded.values():
+            if le._etype is old:
+                le._table = old.lookup[le.spl[4]]
+
+        return old
 
     def find_item(self, name):
+        self.etypes.provide_item(name)
+
         return self.item_types.get(name, None)
 
     def find_place(self, name):
-        return self.places.get(name, None)
+        p = self.places.get(name, None)
+
+        # Callers may well change its items (see journal.py).
+        if p is not None and self.journal is not None:
+            self.journal.touch_place(name)
+
+        return p
 
     def from_name(self, name):
         if name in self.entity_names:
@@ -480,22 +1460,38 @@ class GameWorld(object):
         return None
 
     def from_id(self, eid):
-        if eid not in self.entities:
+        """Returns the entity with the given ID, or None if there is
+        no such entity or if it has despawned this tick."""
+        e = self.entities.get(eid)
+
+        if e is None:
+            return None
+
+        e = self.from_ent(e)
+
+        if e.despawned:
             return None
-    
-        return self.from_ent(self.entities[eid])
+
+        return e
 
     def from_ent(self, e):
         assert e[0] in self.entities
-        return LoadedEntity(self, e)
+        return self._wrap(e)
 
     def __iter__(self):
         return (self.from_ent(e) for e in self.entities.values())
 
     def all_in_place(self, cplace):
-        for e in self:
-            if e.place == cplace:
-                yield e
+        # Iterate over a copy, since entities may move away
+        # (or despawn) while the caller consumes the generator.
+        for eid in tuple(self.place_index.get(cplace, ())):
+            e = self.entities.get(eid)
+
+            if e is not None:
+                e = self.from_ent(e)
+
+                if not e.despawned:
+                    yield e
 
 class GameLoader(object):
     """A class which children will load
@@ -526,194 +1522,413 @@ class GameLoader(object):
 class XMLGameLoader(object):
     """The default loader. Sentient Mushes: Adventure is XML!
     (I'm tired of people telling me XML sucks, please shut up,
-    I use what I want! I'm *indie*!)"""
+    I use what I want! I'm *indie*!)
 
-    def load_world(self, filename):
+    Attribute libraries (files imported by entity types' defaults)
+    and attribute values are only parsed once per loader, however
+    many entity types share them; see load_library.
+
+    If lazy, entity types are only skimmed when loading a world (see
+    scan_entity_type), and added to it as stubs; each is fully loaded
+    the first time the world needs it (see EntityTypeTable), so that
+    types nothing uses cost next to nothing.
+
+    Compiled code is cached in embedcode.CACHE_DIR under base_path,
+    which is the working directory the loader was made in by default,
+    since that is where files are looked up from too."""
+
+    def __init__(self, lazy=True, base_path=None):
+        self.libraries = {} # (path, modification time) -> parsed library
+        self.scans = {} # (path, modification time) -> skimmed library
+        self.literals = {} # attribute value source -> its value
+        self.sources = {} # ordered set of every file read so far
+        self.funcholder = None # CodeHolder of the last world loaded, see hotreload
+
+        self.lazy = lazy
+        self.base_path = os.path.abspath(base_path or os.curdir)
+
+    def new_funcholder(self):
+        """A CodeHolder caching its compiled code under base_path."""
+        return embedcode.CodeHolder(os.path.join(self.base_path, embedcode.CACHE_DIR))
+
+    def load_world(self, filename, populate=True, world_class=None, seed=None):
         """Returns a GameWorld instance containing all of the
         Location instances that represent places in
-        the game world."""
-        xworld = etree.parse(open(filename))
+        the game world.
+
+        If populate is False, places are loaded without spawning
+        their flocks and entities. world_class may be a GameWorld
+        subclass to instantiate instead of GameWorld itself. seed
+        seeds the world's random streams (see rng.RandomService)."""
+        layout = self.read_world(filename)
+
+        world = (world_class or GameWorld)(beginning=layout['beginning'], seed=seed)
+        funcholder = self.funcholder = self.new_funcholder()
 
-        world = GameWorld(beginning=xworld.getroot().get('beginning'))
-        funcholder = embedcode.CodeHolder()
+        if self.lazy:
+            logging.info("Skimming entity types...")
+
+            self.add_stubs(world, layout['etypes'], funcholder)
+            self.build_places(world, layout, populate)
+
+            return world
 
         logging.info("Loading entity types...")
 
-        for el in xworld.getroot():
-            if el.tag == 'etypes':
-                for t in el:
-                    if t.tag == 'etype':
-                        (e, items) = self.load_entity_type(world, t.get('filename'), funcholder)
-                        world.etypes[e.id] = e
+        for fn in layout['etypes']:
+            (e, items) = self.load_entity_type(world, fn, funcholder)
+            world.etypes[e.id] = e
 
-                        for item in items:
-                            world.item_types[item['name']] = item
+            for item in items:
+                world.item_types[item['name']] = item
 
         funcholder.deinit()
 
-        logging.info("Loading and populating places...")
+        self.build_places(world, layout, populate)
 
-        for el in xworld.getroot():
-            if el.tag == "places":
-                for p in el:
-                    if p.tag == "place":
-                        i = {}
-                        attr = {}
+        return world
 
-                        for sub in p:
-                            if sub.tag == "flock":
-                                if sub.get('type') in world.etypes:
-                                    amount = sub.get('amount')
+    def add_stubs(self, world, filenames, funcholder):
+        """Adds the entity types in the given files to a world as stubs,
+        to be loaded through funcholder when first needed.
 
-                                    if '-' in amount:
-                                        amount = random.randint(int(amount.split('-')[0]), int(amount.split('-')[1]))
+        An item type defined by several entity types ends up as the
+        last one's, like when loading them all up front."""
+        def load(stub):
+            (e, items) = self.load_entity_type(world, stub.filename, funcholder)
+            funcholder.deinit()
 
-                                    else:
-                                        amount = int(amount)
+            for item in items:
+                # Other definitions only stand in until the owner's
+                # is loaded.
+                if world.etypes.item_owners.get(item['name'], e.id) == e.id or item['name'] not in world.item_types:
+                    world.item_types[item['name']] = item
 
-                                    for _ in range(amount):
-                                        world.add_entity(world.etypes[sub.get('type')].instantiate(world, p.get('name'), (random.choice(sub.get('variant').split(';')) if sub.get('variant') != '*' else random.choice(tuple(world.etypes[sub.get('type')].variants.keys())))))
+            return e
 
-                                    # print('  * Adding {} {} entities.'.format(amount, world.etypes[sub.get('type')].name))
+        world.etypes.loader = load
 
-                            elif sub.tag == "entity":
-                                if sub.get('type') in world.etypes:
-                                    world.add_entity(world.etypes[sub.get('type')].instantiate(world, p.get('name'), (random.choice(sub.get('variant').split(';')) if sub.get('variant') != '*' else random.choice(tuple(world.etypes[sub.get('type')].variants.keys())))))
+        for fn in filenames:
+            world.etypes.add_stub(self.scan_entity_type(fn))
 
-                            elif sub.tag == "attr":
-                                attr[sub.get('key')] = sub.get('value', None)
+    def scan_entity_type(self, filename):
+        """Skims an entity type file into an EntityTypeStub, without
+        compiling its code, evaluating attributes (besides isPlayer) or
+        reading its systems. Player variants are worked out the way
+        load_entity_type and EntityType would."""
+        unset = object()
 
-                            elif sub.tag == "items":
-                                if world.find_item(sub.get('type')):
-                                    amount = sub.get('amount')
+        root = {}
+        base = {'isPlayer': unset, 'flag': False}
+        variants = []
+        items = []
+        path = []
+        sources = {filename: None}
 
-                                    if amount:
-                                        if '-' in amount:
-                                            amount = random.randint(int(amount.split('-')[0]), int(amount.split('-')[1]))
+        def apply_library(href):
+            sources[href] = None
 
-                                        else:
-                                            amount = int(amount)
+            for op in self.scan_library(href):
+                if op[0] == 'import':
+                    apply_library(op[1])
 
-                                    else:
-                                        amount = 1
+                elif op[0] == 'static':
+                    if base['isPlayer'] is unset:
+                        base['isPlayer'] = self.literal(op[1])
 
-                                    if sub.get('type') in i:
-                                        i[sub.get('type')] += amount
+                elif op[0] == 'flag':
+                    base['flag'] = op[1]
 
-                                    else:
-                                        i[sub.get('type')] = amount
+                elif op[0] == 'item':
+                    items.append(op[1])
+
+        def start(tag, attrib):
+            parent = path[-1] if path else None
+            path.append(tag)
+
+            if parent is None:
+                root.update(attrib)
+
+            elif parent == 'base' and attrib.get('name') == 'isPlayer':
+                if tag == 'attr':
+                    base['isPlayer'] = self.literal(attrib.get('value'))
+
+                elif tag in ('flag', 'unflag'):
+                    base['flag'] = tag == 'flag'
+
+            elif parent == 'default' and tag == 'import':
+                apply_library(attrib.get('href'))
+
+            elif parent == 'systems' and tag == 'system':
+                sources[attrib.get('href')] = None
+
+            elif parent == 'itemdefs' and tag == 'item':
+                items.append(attrib.get('name'))
+
+            elif parent == 'variants' and tag == 'variant':
+                variants.append({'id': attrib.get('id'), 'isPlayer': unset, 'flag': False})
+
+            elif parent == 'variant' and attrib.get('name') == 'isPlayer':
+                if tag == 'attr':
+                    variants[-1]['isPlayer'] = self.literal(attrib.get('value'))
+
+                elif tag in ('flag', 'unflag'):
+                    variants[-1]['flag'] = tag == 'flag'
+
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = start
+        parser.EndElementHandler = lambda tag: path.pop()
+
+        with open(filename, 'rb') as fp:
+            parser.ParseFile(fp)
+
+        self.sources[filename] = None
+
+        player_variants = []
+
+        for v in variants:
+            attr = v['isPlayer'] if v['isPlayer'] is not unset else base['isPlayer']
+
+            # (base flags are added to every variant, see EntityType)
+            if (attr is not unset and attr) or v['flag'] or base['flag']:
+                player_variants.append(v['id'])
+
+        return EntityTypeStub(filename, root.get('name'), root.get('id'), player_variants, items, sources)
+
+    def scan_library(self, href):
+        """Skims an attribute library for scan_entity_type: returns its
+        imports, isPlayer statics and flags, and item types, in order.
+        Cached like load_library."""
+        key = (os.path.abspath(href), os.path.getmtime(href))
+        ops = self.scans.get(key)
+
+        if ops is not None:
+            return ops
+
+        ops = []
+        depth = [0]
+
+        def start(tag, attrib):
+            depth[0] += 1
+
+            if depth[0] != 2:
+                return
+
+            if tag == 'import':
+                ops.append(('import', attrib.get('href')))
+
+            elif tag == 'static' and attrib.get('name') == 'isPlayer':
+                ops.append(('static', attrib.get('value')))
+
+            elif tag in ('flag', 'unflag') and attrib.get('name') == 'isPlayer':
+                ops.append(('flag', tag == 'flag'))
 
-                        logging.debug("- Loaded place {}".format(p.get('name')))
+            elif tag == 'item':
+                ops.append(('item', attrib.get('name')))
 
-                        new_place = {
-                            'name': p.get('name'),
-                            'attr': attr,
-                            'items': i
-                        }
+        def end(tag):
+            depth[0] -= 1
 
-                        world.places[p.get('name')] = new_place
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+
+        with open(href, 'rb') as fp:
+            parser.ParseFile(fp)
+
+        self.sources[href] = None
+        self.scans[key] = ops
+
+        return ops
+
+    def read_world(self, filename):
+        """Parses a world file into its layout: the entity type files
+        it uses, its places, each with the steps that populate it, in
+        order, and its paths. See build_places."""
+        xworld = etree.parse(open(filename))
+        self.sources[filename] = None
+
+        layout = {
+            'beginning': xworld.getroot().get('beginning'),
+            'etypes': [],
+            'places': [], # (name, [(step, ...)])
+            'paths': [],
+        }
+
+        for el in xworld.getroot():
+            if el.tag == 'etypes':
+                for t in el:
+                    if t.tag == 'etype':
+                        layout['etypes'].append(t.get('filename'))
+
+            elif el.tag == "places":
+                for p in el:
+                    if p.tag == "place":
+                        layout['places'].append((p.get('name'), self.read_place(p)))
 
             elif el.tag == "paths":
                 for p in el:
                     if p.tag == "path":
-                        world.paths.append(set(p.get('ends').split(';')))
+                        layout['paths'].append(p.get('ends').split(';'))
+
+        return layout
+
+    def read_place(self, el):
+        """Returns the steps populating a <place> element (see
+        build_place)."""
+        steps = []
+
+        for sub in el:
+            if sub.tag == "flock":
+                steps.append(('flock', sub.get('type'), sub.get('variant'), sub.get('amount')))
+
+            elif sub.tag == "entity":
+                steps.append(('entity', sub.get('type'), sub.get('variant')))
+
+            elif sub.tag == "attr":
+                steps.append(('attr', sub.get('key'), sub.get('value', None)))
+
+            elif sub.tag == "items":
+                steps.append(('items', sub.get('type'), sub.get('amount')))
+
+        return steps
+
+    def build_places(self, world, layout, populate=True):
+        """Adds the places and paths of a layout made by read_world to
+        a world that knows its entity types, spawning their flocks and
+        entities unless populate is False."""
+        logging.info("Loading and populating places...")
+
+        for name, steps in layout['places']:
+            self.build_place(world, name, steps, populate)
+
+        for ends in layout['paths']:
+            world.add_path(ends)
 
         logging.info("World loaded!")
 
-        return world
+    def build_place(self, world, name, steps, populate=True):
+        """Adds a single place, given its steps (see read_world)."""
+        i = {}
+        attr = {}
+
+        for step in steps:
+            if step[0] == "flock":
+                if populate and step[1] in world.etypes:
+                    amount = step[3]
 
-    def load_entity_type(self, world, filename, funcholder=None):
+                    if '-' in amount:
+                        amount = world.rng.spawning.randint(int(amount.split('-')[0]), int(amount.split('-')[1]))
+
+                    else:
+                        amount = int(amount)
+
+                    world.spawn_many(step[1], name, step[2], amount)
+
+                    # print('  * Adding {} {} entities.'.format(amount, world.etypes[step[1]].name))
+
+            elif step[0] == "entity":
+                if populate and step[1] in world.etypes:
+                    world.spawn_many(step[1], name, step[2])
+
+            elif step[0] == "attr":
+                attr[step[1]] = step[2]
+
+            elif step[0] == "items":
+                if world.find_item(step[1]):
+                    amount = step[2]
+
+                    if amount:
+                        if '-' in amount:
+                            amount = world.rng.spawning.randint(int(amount.split('-')[0]), int(amount.split('-')[1]))
+
+                        else:
+                            amount = int(amount)
+
+                    else:
+                        amount = 1
+
+                    if step[1] in i:
+                        i[step[1]] += amount
+
+                    else:
+                        i[step[1]] = amount
+
+        logging.debug("- Loaded place {}".format(name))
+
+        new_place = {
+            'name': name,
+            'attr': attr,
+            'items': i,
+            'stock': dict(i)
+        }
+
+        world.places[name] = new_place
+
+    def load_entity_type(self, world, filename, funcholder=None, override=False):
         """Returns an EntityType instance.
 
         The filename is one of the entity type filenames
         described by the world. EntityType must be called
         to create the instance after processing the file's
-        content."""
+        content.
+
+        If override, code fragments already run by funcholder are
+        replaced by their current source where it changed (see
+        CodeHolder.set); see hotreload."""
 
         try:
-            item_types = [] # Entity's item definitions
+            item_types = {} # Entity's item definitions, by name
 
             etype = etree.parse(open(filename), parser=LineTrackingParser())
+            self.sources[filename] = None
             name = etype.getroot().get('name')
             id = etype.getroot().get('id')
 
             functions = {}
+            priorities = {} # function name -> import depth it came from (0 if defined here)
             base = { 'attr': {}, 'flags': set() }
             variants = {}
             systems = []
             default = {}
 
-            def import_attr(el, level=1):
-                href = el.get('href')
-                imported = etree.parse(open(href), parser=LineTrackingParser())
-
-                for a in imported.getroot():
-                    if a.tag == "attribute":
-                        if a.get('key') not in default:
-                            default[a.get('key')] = eval(a.get('value'))
-
-                    elif a.tag == "declare":
-                        default[a.get('key')] = None
-
-                    elif a.tag == "import":
-                        import_attr(a, level + 1)
-
-                    elif a.tag == "flag":
-                        base['flags'].add(a.get('name'))
+            def import_attr(href, level=1):
+                for op in self.load_library(href, funcholder, override):
+                    kind = op[0]
 
-                    elif a.tag == "unflag":
-                        base['flags'] -= {a.get('name')}
+                    if kind == "attribute":
+                        if op[1] not in default:
+                            default[op[1]] = self.literal(op[2])
 
-                    elif a.tag == "static" and a.get('name') not in base['attr']:
-                        base['attr'][a.get('name')] = eval(a.get('value'))
-
-                    elif a.tag == "function":
-                        if (a.get('name') not in functions) or (level <= getattr(functions[a.get('name')], '__priority', 0)):
-                            fname = a.get('name')
-
-                            for fnc in funcholder.quick("{}-{}".format(imported.getroot().get('name'), a.get('name')), a.text, linepad=a._start_line, filename=href).values():
-                                if fnc.__lookup_name__ == fname:
-                                    setattr(fnc, '__priority', level)
-                                    setattr(fnc, '__funcspace', imported.getroot().get('name'))
-
-                                    functions[fname] = fnc
-
-                                    break
+                    elif kind == "declare":
+                        default[op[1]] = None
 
-                            else: raise RuntimeError("No matching function for method '{}' in while parsing Attribute Imports '{}' referenced by Entity Type '{}'!".format(fname, imported.getroot().get('name'), id))
+                    elif kind == "import":
+                        import_attr(op[1], level + 1)
 
-                    elif a.tag == 'item':
-                        name = a.get('name')
+                    elif kind == "flag":
+                        base['flags'].add(op[1])
 
-                        i = {
-                            'name': name,
-                            'functions': {},
-                            'attr': {},
-                            'flags': set()
-                        }
+                    elif kind == "unflag":
+                        base['flags'] -= {op[1]}
 
-                        for char in a:
-                            if char.tag == 'function':
-                                i['functions'][char.get('name')] = funcholder.quick('{}-{}'.format(a.get('name'), char.get('name')), char.text, linepad=char._start_line, filename=href)
+                    elif kind == "static" and op[1] not in base['attr']:
+                        base['attr'][op[1]] = self.literal(op[2])
 
-                            elif char.tag == 'attribute':
-                                val = char.get('value')
+                    elif kind == "function":
+                        fname, fnc = op[1], op[2]
 
-                                if val:
-                                    i['attr'][char.get('key')] = eval(val)
+                        if (fname not in functions) or (level <= priorities.get(fname, 0)):
+                            priorities[fname] = level
+                            functions[fname] = fnc
 
-                                else:
-                                    i['attr'][char.get('key')] = None
-
-                            elif char.tag == 'flag':
-                                i['flags'].add(char.get('name'))
-
-                        item_types.append(i)
+                    elif kind == "item":
+                        item_types[op[1]['name']] = op[1]
 
             _f = funcholder is None
 
             if _f:
-                funcholder = embedcode.CodeHolder()
+                funcholder = self.new_funcholder()
 
             for sub in etype.getroot():
                 if sub.tag == "functions":
@@ -721,7 +1936,7 @@ class XMLGameLoader(object):
                         if f.tag == "function":
                             fname = f.get('name')
 
-                            for fnc in funcholder.quick("{}-{}".format(id, f.get('name')), f.text, linepad=f._start_line, filename=filename).values():
+                            for fnc in funcholder.quick("{}-{}".format(id, f.get('name')), f.text, linepad=f._start_line, filename=filename, override=override).values():
                                 if fnc.__lookup_name__ == fname:
                                     functions[fname] = fnc
                                     break
@@ -731,7 +1946,7 @@ class XMLGameLoader(object):
                 elif sub.tag == "base":
                     for a in sub:
                         if a.tag == "attr":
-                            base['attr'][a.get('name')] = eval(a.get('value'))
+                            base['attr'][a.get('name')] = self.literal(a.get('value'))
 
                         elif a.tag == "flag":
                             base['flags'].add(a.get('name'))
@@ -743,8 +1958,9 @@ class XMLGameLoader(object):
                     for sys in sub:
                         if sys.tag == "system":
                             sname = sys.get('name')
+                            self.sources[sys.get('href')] = None
 
-                            for fnc in funcholder.quick("{}-{}".format(id, sname), open(sys.get('href')).read(), filename=sys.get('href')).values():
+                            for fnc in funcholder.quick("{}-{}".format(id, sname), open(sys.get('href')).read(), filename=sys.get('href'), override=override).values():
                                 if fnc.__lookup_name__ == sname:
                                     systems.append(fnc)
                                     break
@@ -755,13 +1971,13 @@ class XMLGameLoader(object):
                     for att in sub:
                         if att.tag == "import":
                             # print("Importing attribute library: {}".format(a.get('name')))
-                            import_attr(att)
+                            import_attr(att.get('href'))
 
                         elif a.tag == "declare":
                             default[att.get('key')] = None
 
                         elif att.tag == "attribute":
-                            default[att.get('key')] = eval(att.get('value'))
+                            default[att.get('key')] = self.literal(att.get('value'))
 
                 elif sub.tag == "itemdefs":
                     for item in sub:
@@ -777,7 +1993,7 @@ class XMLGameLoader(object):
                                 if char.tag == 'function':
                                     cname = char.get('name')
 
-                                    for fnc in funcholder.quick('{}-{}'.format(i['name'], cname), char.text, linepad=char._start_line, filename=filename).values():
+                                    for fnc in funcholder.quick('{}-{}'.format(i['name'], cname), char.text, linepad=char._start_line, filename=filename, override=override).values():
                                         if fnc.__lookup_name__ == cname:
                                             i['functions'][cname] = fnc
                                             break
@@ -788,7 +2004,7 @@ class XMLGameLoader(object):
                                     val = char.get('value')
 
                                     if val:
-                                        i['attr'][char.get('key')] = eval(val)
+                                        i['attr'][char.get('key')] = self.literal(val)
 
                                     else:
                                         i['attr'][char.get('key')] = None
@@ -796,7 +2012,7 @@ class XMLGameLoader(object):
                                 elif char.tag == 'flag':
                                     i['flags'].add(char.get('name'))
 
-                            item_types.append(i)
+                            item_types[i['name']] = i
 
                 elif sub.tag == "variants":
                     for va in sub:
@@ -804,7 +2020,7 @@ class XMLGameLoader(object):
 
                         for a in va:
                             if a.tag == "attr":
-                                v['attr'][a.get('name')] = eval(a.get('value'))
+                                v['attr'][a.get('name')] = self.literal(a.get('value'))
 
                             elif a.tag == "flag":
                                 v['flags'].add(a.get('name'))
@@ -813,7 +2029,7 @@ class XMLGameLoader(object):
                                 v['flags'] -= {a.get('name')}
 
                             elif a.tag == "default":
-                                v['default'][a.get('key')] = eval(a.get('value'))
+                                v['default'][a.get('key')] = self.literal(a.get('value'))
 
                             elif a.tag == "system":
                                 sname = sys.get('name')
@@ -833,4 +2049,94 @@ class XMLGameLoader(object):
 
         logging.debug("Imported Entity Type {}, with {} variants, {} functions and {} item types loaded.".format(name, len(variants), len(functions), len(item_types)))
 
-        return (EntityType(name, id, base, variants, functions, systems, default), item_types)
+        res = EntityType(name, id, base, variants, functions, systems, default)
+        res.filename = filename
+
+        return (res, list(item_types.values()))
+
+    def literal(self, source):
+        """Evaluates an attribute value as written in XML, once per
+        distinct source. Mutable values are copied on the way out, so
+        nothing ends up shared by accident."""
+        try:
+            val = self.literals[source]
+
+        except KeyError:
+            val = self.literals[source] = eval(source)
+
+        if isinstance(val, (list, dict, set)):
+            return copy.deepcopy(val)
+
+        return val
+
+    def load_library(self, href, funcholder, override=False):
+        """Parses an attribute library into a list of operations for
+        load_entity_type to apply, compiling its functions and building
+        its items along the way. Libraries are cached by path and
+        modification time, so each is only parsed once however many
+        entity types import it, and parsed again once changed."""
+        key = (os.path.abspath(href), os.path.getmtime(href))
+        ops = self.libraries.get(key)
+
+        if ops is not None:
+            return ops
+
+        imported = etree.parse(open(href), parser=LineTrackingParser())
+        self.sources[href] = None
+        lname = imported.getroot().get('name')
+        ops = []
+
+        for a in imported.getroot():
+            if a.tag in ("attribute", "declare"):
+                ops.append((a.tag, a.get('key'), a.get('value')))
+
+            elif a.tag in ("flag", "unflag"):
+                ops.append((a.tag, a.get('name')))
+
+            elif a.tag == "import":
+                ops.append((a.tag, a.get('href')))
+
+            elif a.tag == "static":
+                ops.append((a.tag, a.get('name'), a.get('value')))
+
+            elif a.tag == "function":
+                fname = a.get('name')
+
+                for fnc in funcholder.quick("{}-{}".format(lname, fname), a.text, linepad=a._start_line, filename=href, override=override).values():
+                    if fnc.__lookup_name__ == fname:
+                        setattr(fnc, '__funcspace', lname)
+                        ops.append((a.tag, fname, fnc))
+
+                        break
+
+                else: raise RuntimeError("No matching function for method '{}' in while parsing Attribute Imports '{}' ({})!".format(fname, lname, href))
+
+            elif a.tag == 'item':
+                i = {
+                    'name': a.get('name'),
+                    'functions': {},
+                    'attr': {},
+                    'flags': set()
+                }
+
+                for char in a:
+                    if char.tag == 'function':
+                        i['functions'][char.get('name')] = funcholder.quick('{}-{}'.format(a.get('name'), char.get('name')), char.text, linepad=char._start_line, filename=href, override=override)
+
+                    elif char.tag == 'attribute':
+                        val = char.get('value')
+
+                        if val:
+                            i['attr'][char.get('key')] = self.literal(val)
+
+                        else:
+                            i['attr'][char.get('key')] = None
+
+                    elif char.tag == 'flag':
+                        i['flags'].add(char.get('name'))
+
+                ops.append((a.tag, i))
+
+        self.libraries[key] = ops
+
+        return ops
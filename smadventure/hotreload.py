@@ -0,0 +1,189 @@
+"""
+Hot reloading of entity types.
+
+HotReloader watches the files a world's entity types come from (entity
+type files, the attribute libraries they import and their systems). Once
+any of them changes, it loads the entity types using it again and swaps
+them into the running world between ticks (see
+GameWorld.replace_entity_type), so content can be patched without a
+restart. Entities keep their state; only their types' functions,
+systems, variants and defaults change. Defaults only apply to entities
+spawned from then on.
+
+Only code fragments whose source changed are compiled and run again
+(see CodeHolder.set); the functions of the others stay as they are,
+module-level state and all.
+
+Changes are noticed by polling modification times, every interval
+seconds. A file that fails to load is logged and left alone until it
+changes again, with its entity types keeping their previous definition.
+Entity types that weren't loaded yet (see EntityTypeTable) are merely
+skimmed again. Entity types added to or removed from the world file,
+like places and paths, need a restart.
+"""
+
+import logging
+import os
+import trio
+
+from . import engine
+
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+
+    except OSError:
+        return None
+
+
+class HotReloader(object):
+    """Reloads a world's entity types as their files change; see the
+    module's description. loader is the one that loaded the world (or
+    any XMLGameLoader); fragments it compiled are only compiled again
+    if changed."""
+
+    def __init__(self, world, loader, interval=2):
+        self.world = world
+        self.loader = loader
+        self.interval = interval
+
+        if getattr(loader, 'funcholder', None) is None:
+            loader.funcholder = loader.new_funcholder()
+
+        self.dependents = {} # file -> ordered set of IDs of the entity types using it
+        self.mtimes = {} # file -> modification time when last loaded
+
+        self.last_reload = None # (tick, IDs of the entity types reloaded)
+        self._lock = trio.Lock()
+
+        for id, filename in self.etype_files().items():
+            self.track(id, filename)
+
+    def etype_files(self):
+        """Entity type ID -> the file it is loaded from, for every entity
+        type the world knows that came from one, in the order the world
+        file lists them."""
+        etypes = self.world.etypes
+        res = {id: stub.filename for id, stub in etypes.stubs.items()}
+
+        for id, etype in etypes.items():
+            if etype.filename is not None:
+                res[id] = etype.filename
+
+        return res
+
+    def track(self, id, filename):
+        """(Re)reads which files an entity type uses, and returns its
+        EntityTypeStub."""
+        stub = self.loader.scan_entity_type(filename)
+
+        for ids in self.dependents.values():
+            ids.pop(id, None)
+
+        for path in stub.sources:
+            self.dependents.setdefault(path, {})[id] = None
+
+            if path not in self.mtimes:
+                self.mtimes[path] = _mtime(path)
+
+        return stub
+
+    def changed(self):
+        """Files changed since they were last loaded, with their new
+        modification times."""
+        res = {}
+
+        for path, mtime in self.mtimes.items():
+            now = _mtime(path)
+
+            if now != mtime:
+                res[path] = now
+
+        return res
+
+    def reload(self, id, filename):
+        """Loads an entity type again from its file, and swaps it into
+        the world. Must be called between ticks."""
+        etypes = self.world.etypes
+        stub = self.track(id, filename)
+
+        if id in etypes.pending:
+            etypes.add_stub(stub)
+            return
+
+        holder = self.loader.funcholder
+
+        try:
+            etype, items = self.loader.load_entity_type(self.world, filename, holder, override=True)
+
+        finally:
+            holder.deinit()
+
+        if id in etypes.stubs:
+            etypes.add_stub(stub)
+
+        self.world.replace_entity_type(etype)
+
+        # (see XMLGameLoader.add_stubs)
+        for item in items:
+            if etypes.item_owners.get(item['name'], etype.id) == etype.id or item['name'] not in self.world.item_types:
+                self.world.item_types[item['name']] = item
+
+    def reload_changed(self, changed=None):
+        """Reloads every entity type using a changed file (see changed).
+        Must be called between ticks. Returns the IDs of the entity
+        types reloaded."""
+        if changed is None:
+            changed = self.changed()
+
+        affected = {}
+
+        for path in changed:
+            affected.update(self.dependents.get(path, {}))
+
+        self.mtimes.update(changed)
+
+        reloaded = []
+
+        for id, filename in self.etype_files().items():
+            if id not in affected:
+                continue
+
+            try:
+                self.reload(id, filename)
+
+            except Exception:
+                logging.exception("Could not reload entity type {} from {}; keeping the previous definition.".format(id, filename))
+
+            else:
+                reloaded.append(id)
+
+        if reloaded:
+            self.last_reload = (self.world.tick_count, reloaded)
+            logging.info("Reloaded entity types {} after changes to {}.".format(', '.join(reloaded), ', '.join(changed)))
+
+        return reloaded
+
+    async def check(self):
+        changed = self.changed()
+
+        if not changed:
+            return []
+
+        async with self._lock:
+            while self.world._ticking:
+                await trio.sleep(0)
+
+            return self.reload_changed(changed)
+
+    async def run(self):
+        while True:
+            await trio.sleep(self.interval)
+
+            try:
+                await self.check()
+
+            except Exception:
+                logging.exception("Hot reload check failed")
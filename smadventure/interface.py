@@ -1,6 +1,6 @@
-from typing import Set
-
+import logging
 import math
+import os
 import random
 import triarc.bot
 import string
@@ -8,7 +8,7 @@ import time
 
 from collections import deque
 
-from . import engine, namegen, player
+from . import bundle, engine, hotreload, journal, mapped, namegen, outbox, player, replay, snapshot, streaming
 from .common import plural, size_cm
 
 
@@ -38,15 +38,51 @@ class PlayerPad:
         return False
 
 
-def make_game(world_file: str, prefix: str) -> (triarc.bot.CommandBot, engine.GameWorld):
-    loader = engine.XMLGameLoader()
-    world = loader.load_world(world_file)
+# Commands left out of command logs: pads are secret, and replays
+# could not use them anyway.
+UNLOGGED_COMMANDS = {'makepad', 'usepad'}
+
+class ReplayEvent:
+    """Stands in for a chat message when replaying a command log.
+    Replies go nowhere."""
+
+    def __init__(self, author_addr, author_name):
+        self.author_addr = author_addr
+        self.author_name = author_name
+
+    async def reply(self, *args, **kwargs):
+        pass
+
+    reply_privately = reply
+    reply_private = reply
+
+
+def make_game(world_file: str, prefix: str, lod_radius: int = None, seed: int = None, command_log: str = None, snapshot_file: str = None, journal_file: str = None, bundle_file: str = None, streaming_load: bool = False, hot_reload: float = None) -> (triarc.bot.CommandBot, engine.GameWorld):
+    if bundle_file:
+        loader = bundle.BundleGameLoader(bundle_file)
+
+    elif streaming_load:
+        loader = streaming.StreamingGameLoader()
+
+    else:
+        loader = engine.XMLGameLoader()
+
+    world = loader.load_world(world_file, seed=seed)
+    world.lod_radius = lod_radius
+    log = None
+    log_backends = {}
+
+    if command_log:
+        log = replay.CommandLog(open(command_log, 'w'), world_file, world.rng.seed, lod_radius)
     players = {}
     player_pads = {}
     turn_rotation = deque([None])
     player_addrs = {}
     player_names = {}
     last_chan = {}
+    backend_buckets = {} # backend -> outbox.TokenBucket, shared by everyone talking through it
+    addr_buckets = {} # author address -> their backend's TokenBucket
+    restored_names = {} # author address -> player name, from a snapshot
     _chan_already = set()
 
     def turn_name():
@@ -58,20 +94,25 @@ def make_game(world_file: str, prefix: str) -> (triarc.bot.CommandBot, engine.Ga
 
         return player_addrs[turn_rotation[0]]
 
-    async def _infra_channel(m, place, level):
-        for chan in set(last_chan.values()):
-            await chan.reply(m)
+    async def _infra_send(line):
+        for addr, chan in tuple(last_chan.items()):
+            await addr_buckets[addr].take()
+            await chan.reply(line)
 
-        return True
-
-    world.add_broadcast_channel(engine.BCAST_EVENT, _infra_channel, name='infrachannel')
+    world.add_broadcast_channel(engine.BCAST_EVENT, outbox.Outbox(_infra_send), name='infrachannel')
 
     class SMAdventureBot(triarc.bot.CommandBot):
         def __init__(self, name):
             super().__init__(name, [], prefix)
 
+            self.handlers = {} # command name -> handler, for replays
+            self.reloader = None # hotreload.HotReloader, if hot_reload is set
+
     bot = SMAdventureBot('smadventure')
 
+    if hot_reload:
+        bot.reloader = hotreload.HotReloader(world, loader, hot_reload)
+
     def _rotate_turn():
         turn_rotation.rotate(-1)
 
@@ -108,9 +149,19 @@ def make_game(world_file: str, prefix: str) -> (triarc.bot.CommandBot, engine.Ga
 
                     async def __call__(self, interface, event, *args):
                         last_chan[event.author_addr] = event
+                        addr_buckets[event.author_addr] = backend_buckets.setdefault(id(interface), outbox.TokenBucket())
+
+                        if event.author_addr in restored_names:
+                            player_names.setdefault((id(interface), event.author_addr), restored_names.pop(event.author_addr))
+
+                        if log is not None and name not in UNLOGGED_COMMANDS:
+                            backend = log_backends.setdefault(id(interface), len(log_backends))
+                            log.record(world.tick_count, backend, event.author_addr, event.author_name, name, args)
+
                         return await func(interface, event, *args)
 
                 defined = DefinedCommand(game_relevant)
+                bot.handlers[name] = defined
 
                 return define(defined)
 
@@ -220,6 +271,35 @@ def make_game(world_file: str, prefix: str) -> (triarc.bot.CommandBot, engine.Ga
         player_names[id(interface), event.author_addr] = pl_name
         await message.reply("{}: Pad used with success! You may not reuse it now. Nonetheless, you now play as {}!".format(event.author_name, str(players[pl_name].entity)))
 
+    def _attach_player(pl_name: str, p: player.PlayerInterface, addr: str):
+        async def _super_send(line: str):
+            chan = last_chan.get(addr)
+
+            if chan is not None:
+                await addr_buckets[addr].take()
+                await chan.reply(line)
+
+        # Events reach everyone through the infra channel already.
+        _super_channel = outbox.Outbox(_super_send)
+        world.add_broadcast_channel(engine.BCAST_INFO, _super_channel, name='superchannel:{}'.format(pl_name), follow=p.entity, below=engine.BCAST_EVENT)
+        
+        players[pl_name] = p
+
+        def __handle_dead_player():
+            if pl_name in players:
+                del players[pl_name]
+
+            while pl_name in turn_rotation:
+                turn_rotation.remove(pl_name)
+
+            world.remove_broadcast_channel('superchannel:{}'.format(pl_name))
+
+        if '__handle_dead_player' not in p.entity.type.variants[p.entity.variant['id']]:
+            p.entity.type.variants[p.entity.variant['id']]['__handle_dead_player'] = { p.entity.name: __handle_dead_player }
+
+        else:
+            p.entity.type.variants[p.entity.variant['id']]['__handle_dead_player'][p.entity.name] = __handle_dead_player
+
     @command('join', doc="Join the game!")
     async def player_join(interface: triarc.backend.Backend, event: triarc.bot.Message, name: str = None, *args):
         global _chan_already
@@ -236,8 +316,7 @@ def make_game(world_file: str, prefix: str) -> (triarc.bot.CommandBot, engine.Ga
                         await event.reply('{}: You can only rejoin after a game tick, once your body has fully rot.'.format(event.author_name))
 
                     else:
-                        if players[pl_name].entity.id in world.entities:
-                            del world.entities[players[pl_name].entity.id]
+                        world.remove_entity(players[pl_name].entity.id)
                             
                         break
 
@@ -248,45 +327,16 @@ def make_game(world_file: str, prefix: str) -> (triarc.bot.CommandBot, engine.Ga
 
             break
 
-        types = {}
-
-        for et in world.etypes.values():
-            for k, v in et.variants.items():
-                if v['attr']['isPlayer'] or 'isPlayer' in v['flags']:
-                    if et.id in types:
-                        types[et.id].append(k)
+        types = world.etypes.player_variants()
 
-                    else:
-                        types[et.id] = [k]
+        spawning = world.rng.spawning
 
-        type = random.choice(tuple(types.keys()))
-        variant = random.choice(types[type])
+        type = spawning.choice(tuple(types.keys()))
+        variant = spawning.choice(types[type])
 
-        p = player.PlayerInterface.join(world, pl_name, random.choice(world.beginning.split(';')), type, variant)
+        p = player.PlayerInterface.join(world, pl_name, spawning.choice(world.beginning.split(';')), type, variant)
 
-        async def _super_channel(m: str, place: Set[str], level: int):
-            if place and p.entity.place in place and level < engine.BCAST_EVENT:
-                await last_chan[event.author_addr].reply(m)
-                return True
-
-        world.add_broadcast_channel(engine.BCAST_INFO, _super_channel, name='superchannel:{}'.format(pl_name))
-        
-        players[pl_name] = p
-
-        def __handle_dead_player():
-            if pl_name in players:
-                del players[pl_name]
-
-            while pl_name in turn_rotation:
-                turn_rotation.remove(pl_name)
-
-            world.remove_broadcast_channel('superchannel:{}'.format(pl_name))
-
-        if '__handle_dead_player' not in p.entity.type.variants[p.entity.variant['id']]:
-            p.entity.type.variants[p.entity.variant['id']]['__handle_dead_player'] = { p.entity.name: __handle_dead_player }
-
-        else:
-            p.entity.type.variants[p.entity.variant['id']]['__handle_dead_player'][p.entity.name] = __handle_dead_player
+        _attach_player(pl_name, p, event.author_addr)
 
         assert len(turn_rotation) > 0
 
@@ -515,7 +565,7 @@ def make_game(world_file: str, prefix: str) -> (triarc.bot.CommandBot, engine.Ga
             event.reply('{}: Join first!'.format(event.author_name))
             return
 
-        await event.reply("{}: Here you can see {}.".format(event.author_name, ', '.join("{} the {}".format(world.from_id(e).name, world.from_id(e).variant['name']) for e in world.entities if world.from_id(e)['living'] and world.from_id(e).place == players[pl_name].entity.place)))
+        await event.reply("{}: Here you can see {}.".format(event.author_name, ', '.join("{} the {}".format(e.name, e.variant['name']) for e in world.all_in_place(players[pl_name].entity.place) if e['living'])))
 
     @command('infect', True, doc="Attempts to infect a living creature. A successful infection will render the target a Mush, but requires a weakened immune system, and may be dangerous for their health.")
     async def infect(interface: triarc.backend.Backend, event: triarc.bot.Message, *args):
@@ -544,15 +594,9 @@ def make_game(world_file: str, prefix: str) -> (triarc.bot.CommandBot, engine.Ga
             await event.reply('{}: Join first!'.format(event.author_name))
             return
 
-        pl = set()
-
-        for p in world.paths:
-            if players[pl_name].entity.place in p:
-                pl |= p
-
-        pl -= {players[pl_name].entity.place}
+        pl = world.neighbors(players[pl_name].entity.place)
 
-        await event.reply("{}: From here you can go to {}".format(event.author_name, ', '.join(tuple(pl))))
+        await event.reply("{}: From here you can go to {}".format(event.author_name, ', '.join(pl)))
 
     @command('move', True, doc="Finds a path toward a location, then moves you one place through it. There is a chance for failure, depending in the player class' agility.")
     async def move(interface: triarc.backend.Backend, event: triarc.bot.Message, *args):
@@ -673,4 +717,77 @@ def make_game(world_file: str, prefix: str) -> (triarc.bot.CommandBot, engine.Ga
         if players[pl_name].attack_name(args[0]):
             await next_turn()
 
+    def _snapshot_players():
+        rotation = list(turn_rotation)
+
+        # The AI's turn (None) only leads while its tick runs, which is
+        # when journals commit; save the turn order as of after the tick.
+        if rotation[0] is None and len(rotation) > 1:
+            rotation = rotation[1:] + rotation[:1]
+
+        return {
+            'players': {name: p.entity.id for name, p in players.items()},
+            'addrs': {name: addr for (_, addr), name in player_names.items()},
+            'player_addrs': dict(player_addrs),
+            'turn_rotation': rotation,
+        }
+
+    def _restore_players(state):
+        for name in tuple(players):
+            world.remove_broadcast_channel('superchannel:{}'.format(name))
+
+        players.clear()
+        player_names.clear()
+        player_addrs.clear()
+        player_addrs.update(state['player_addrs'])
+
+        turn_rotation.clear()
+        turn_rotation.extend(state['turn_rotation'])
+
+        for name, eid in state['players'].items():
+            e = world.from_id(eid)
+            addr = state['addrs'].get(name)
+
+            if e is not None and addr is not None:
+                restored_names[addr] = name
+                _attach_player(name, player.PlayerInterface(e, name), addr)
+
+    world.snapshot_providers['interface'] = (_snapshot_players, _restore_players)
+
+    if snapshot_file and journal_file:
+        replayed = journal.recover(world, journal_file, snapshot_file)
+        world.lod_radius = lod_radius
+
+        logging.info("Recovered the world from {} and {} journaled ticks, at tick {}.".format(snapshot_file, replayed, world.tick_count))
+
+        world.enable_journal(journal_file, snapshot_file)
+
+    elif snapshot_file and os.path.exists(snapshot_file):
+        if mapped.is_mapped(snapshot_file):
+            mapped.open_world(world, snapshot_file)
+
+        else:
+            snapshot.load(world, snapshot_file)
+
+        world.lod_radius = lod_radius
+
+        logging.info("Restored the world from {}, at tick {}.".format(snapshot_file, world.tick_count))
+
+    return bot, world
+
+async def replay_session(log_file: str, prefix: str = '==') -> (triarc.bot.CommandBot, engine.GameWorld):
+    """Plays back a command log recorded by make_game, returning the
+    resulting bot and world. Every command is fed back to its handler,
+    in order, as if sent by the same player."""
+    header, commands = replay.read_log(log_file)
+    bot, world = make_game(header['world'], prefix, header.get('lod_radius'), header['seed'])
+    backends = {}
+
+    for c in commands:
+        if world.tick_count != c['tick']:
+            logging.warning("Replay diverged: '{}' was issued at tick {}, but the world is at tick {}!".format(c['command'], c['tick'], world.tick_count))
+
+        interface = backends.setdefault(c['backend'], object())
+        await bot.handlers[c['command']](interface, ReplayEvent(c['addr'], c['author']), *c['args'])
+
     return bot, world
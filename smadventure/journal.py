@@ -0,0 +1,413 @@
+"""
+Append-only world journal, for crash recovery between snapshots.
+
+While a Journal is attached to a world (world.journal), the world tells
+it which entities change: attribute writes and pops, moves, renames,
+variant changes, spawns and removals, as well as which places are
+looked up (through GameWorld.find_place, which is how scripts get at a
+place's items) or regrow. At the end of every tick, the journal commits
+one record holding the current state of each changed entity, the IDs of
+removed ones, every such place, the paths if they changed, and the
+world's counters and random streams. It also holds, in order, every
+place and name index bucket an entity was added to, so that replaying
+keeps the order entities are iterated in (which the game's outcome
+depends on).
+
+Records are marshalled on the game's thread. Compression, writing and
+fsyncing happen on a writer thread, which writes every record waiting
+for it and then fsyncs once (group commit), so committing never waits
+on the disk. If the writer fails, it drops records until the next
+compaction, and commit and close raise a JournalError until then.
+
+Every compact_every commits, or once the journal grows past
+compact_size bytes, the journal is compacted: a fresh snapshot is
+written and the journal starts over, in the format the snapshot file
+already has (regular or mapped, see mapped.py). recover() loads or opens
+the snapshot and replays whatever the journal holds past it.
+
+Changes made in place to nested values (e.g. entity['friends'].append)
+are only caught if something else about the entity is written through
+LoadedEntity in the same tick; assign the value back to be sure, like
+creature_tick does with friends.
+Likewise, places changed through world.places rather than find_place
+must be passed to touch_place.
+"""
+
+import logging
+import marshal
+import os
+import queue
+import struct
+import threading
+import zlib
+
+from . import snapshot, mapped
+
+
+
+MAGIC = b'SMADJRNL'
+FORMAT_VERSION = 2
+
+_HEADER = struct.Struct('<HQB') # format version, tick of the snapshot it follows, compressed
+_FRAME = struct.Struct('<I')
+
+
+class JournalError(Exception):
+    pass
+
+
+class Journal(object):
+    """Records a world's changes to filename, compacting them into
+    snapshot_file every now and then. Attach with world.journal = ...
+    (see GameWorld.enable_journal).
+
+    Compacting writes a mapped snapshot if is_mapped is set, or by
+    default if snapshot_file already holds one."""
+
+    def __init__(self, world, filename, snapshot_file, compact_every=500, compact_size=64 << 20, compress=True, is_mapped=None):
+        self.world = world
+        self.filename = filename
+        self.snapshot_file = snapshot_file
+
+        if is_mapped is None:
+            is_mapped = os.path.exists(snapshot_file) and mapped.is_mapped(snapshot_file)
+
+        self.is_mapped = is_mapped
+        self.compact_every = compact_every
+        self.compact_size = compact_size
+        self.compress = compress
+
+        self.dirty = {} # ordered set of changed entity IDs
+        self.removed = {} # ordered set of removed entity IDs
+        self.places = {} # ordered set of names of possibly changed places
+        self.indexes = {'place_index': {}, 'entity_names': {}} # index -> ordered set of keys added to
+        self.paths_changed = False
+
+        self.commits = 0 # since the last compaction
+        self.size = 0 # bytes queued for the journal file, since the last compaction
+        self.synced_tick = None # last tick known to be on disk
+        self.failed = None # the writer's exception, until a compaction succeeds
+
+        self._queue = queue.Queue()
+        self._fp = None
+
+        # Start from a fresh snapshot; the journal file is only
+        # truncated once it is safely written.
+        self.compact()
+
+        self._thread = threading.Thread(target=self._writer, name='smadventure-journal', daemon=True)
+        self._thread.start()
+
+    # Change tracking, called by the world
+
+    def touch(self, eid):
+        self.dirty[eid] = None
+
+    def remove(self, eid):
+        self.dirty.pop(eid, None)
+        self.removed[eid] = None
+
+    def touch_place(self, name):
+        self.places[name] = None
+
+    def touch_index(self, index, key):
+        self.indexes[index][key] = None
+
+    # Committing
+
+    def commit(self):
+        """Queues a record of everything that changed since the last
+        commit. Called by GameWorld.tick once the tick is over.
+
+        Raises a JournalError if the writer failed, in which case the
+        journal can't be trusted until it is compacted again."""
+        self._check()
+
+        world = self.world
+        entities = world.entities
+        upserts = []
+
+        for eid in self.dirty:
+            e = entities.get(eid)
+
+            if e is not None:
+                upserts.append(e)
+
+        places = {name: world.places[name] for name in self.places if name in world.places}
+
+        record = {
+            'tick': world.tick_count,
+            'rng': world.rng.getstate(),
+            'ids': world.ids.counter,
+            'dormant': world.dormant,
+            'asleep_since': world._asleep_since,
+            'upserts': upserts,
+            'removed': list(self.removed),
+            'places': places,
+            'indexes': {index: {key: tuple(getattr(world, index).get(key, ())) for key in keys} for index, keys in self.indexes.items()},
+            'extra': {name: provider[0]() for name, provider in world.snapshot_providers.items()},
+        }
+
+        if self.paths_changed:
+            record['paths'] = [tuple(p) for p in world.paths]
+            record['adjacency'] = world.adjacency
+
+        data = marshal.dumps(record)
+
+        self.dirty = {}
+        self.removed = {}
+        self.places = {}
+        self.indexes = {index: {} for index in self.indexes}
+        self.paths_changed = False
+
+        self.commits += 1
+        self.size += len(data)
+        self._queue.put(('record', data, world.tick_count))
+
+        if self.commits >= self.compact_every or self.size >= self.compact_size:
+            self.compact()
+
+    def compact(self):
+        """Queues a fresh snapshot, after which the journal starts over.
+        Also how to recover from a writer failure.
+
+        The snapshot is captured right away, on the game's thread, so
+        this pauses the game like an autosave does (see
+        snapshot.capture); only writing it happens on the writer thread."""
+        self.failed = None
+
+        chunk_size = mapped.CHUNK_SIZE if self.is_mapped else snapshot.CHUNK_SIZE
+        self._queue.put(('compact', snapshot.capture(self.world, chunk_size), self.world.tick_count))
+
+        self.commits = 0
+        self.size = 0
+
+    def close(self):
+        """Writes everything still queued, then stops the writer."""
+        self._queue.put(('stop', None, None))
+        self._thread.join()
+
+        self._check()
+
+    def _check(self):
+        if self.failed is not None:
+            raise JournalError("Could not write to the journal {}!".format(self.filename)) from self.failed
+
+    # Writer thread
+
+    def _open(self, base_tick):
+        self._close()
+
+        self._fp = open(self.filename, 'wb')
+        self._fp.write(MAGIC)
+        self._fp.write(_HEADER.pack(FORMAT_VERSION, base_tick, bool(self.compress)))
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+
+    def _writer(self):
+        running = True
+        synced = None
+
+        while running:
+            batch = [self._queue.get()]
+
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+
+                except queue.Empty:
+                    break
+
+            try:
+                for kind, data, tick in batch:
+                    if kind == 'record':
+                        if self._fp is None:
+                            continue # (until the next compaction)
+
+                        if self.compress:
+                            data = zlib.compress(data, 1)
+
+                        self._fp.write(_FRAME.pack(len(data)))
+                        self._fp.write(data)
+
+                    elif kind == 'compact':
+                        if self._fp is not None:
+                            self._fp.flush()
+                            os.fsync(self._fp.fileno())
+
+                        if self.is_mapped:
+                            mapped.write_file(data, self.snapshot_file)
+
+                        else:
+                            snapshot.write_file(data, self.snapshot_file)
+                        self._open(tick)
+                        self.failed = None
+
+                    elif kind == 'stop':
+                        running = False
+
+                    if tick is not None:
+                        synced = tick
+
+                if self._fp is not None:
+                    self._fp.flush()
+                    os.fsync(self._fp.fileno())
+
+                    self.synced_tick = synced
+
+            except Exception as e:
+                logging.exception("Could not write to the journal {}".format(self.filename))
+                self.failed = e
+
+                # Whatever is in the file past the failure can't be
+                # trusted, so drop everything until the next compaction.
+                self._close()
+
+                running = not any(kind == 'stop' for kind, data, tick in batch)
+
+        self._close()
+
+    def _close(self):
+        fp, self._fp = self._fp, None
+
+        if fp is not None:
+            try:
+                fp.close()
+
+            except OSError:
+                pass
+
+
+def records(filename):
+    """Yields every complete record of a journal file. A record cut
+    short (by a crash while writing it) ends the journal."""
+    with open(filename, 'rb') as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a world journal!")
+
+        version, base_tick, compress = _HEADER.unpack(fp.read(_HEADER.size))
+
+        if version != FORMAT_VERSION:
+            raise ValueError("Unsupported journal format version {} (expected {})!".format(version, FORMAT_VERSION))
+
+        while True:
+            size = fp.read(_FRAME.size)
+
+            if not size:
+                return
+
+            data = fp.read(_FRAME.unpack(size)[0]) if len(size) == _FRAME.size else b''
+
+            try:
+                record = marshal.loads(zlib.decompress(data) if compress else data)
+
+            except (zlib.error, ValueError, EOFError):
+                logging.warning("Journal {} ends with an incomplete record; ignoring it.".format(filename))
+                return
+
+            yield record
+
+def _unindex(index, key, eid):
+    bucket = index.get(key)
+
+    if bucket is not None:
+        bucket.pop(eid, None)
+
+        if not bucket:
+            del index[key]
+
+def replay(world, filename):
+    """Applies every journal record newer than the world's current tick.
+    Returns how many records were applied.
+
+    Keeps the indexes up to date as it goes, rather than rebuilding
+    them, so that they keep their order: entities leave their old
+    buckets, and every bucket something was added to is taken as
+    recorded."""
+    entities = world.entities
+    applied = 0
+    extra = None
+
+    for record in records(filename):
+        if record['tick'] <= world.tick_count:
+            continue # already in the snapshot
+
+        for eid in record['removed']:
+            e = entities.pop(eid, None)
+
+            if e is not None:
+                _unindex(world.entity_names, e[2], eid)
+                _unindex(world.place_index, e[3], eid)
+                world.player_ids.pop(eid, None)
+
+        for e in record['upserts']:
+            old = entities.get(e[0])
+
+            if old is None:
+                if world.etypes[e[1]].lookup[e[4]].get('isPlayer') or e[5].get('isPlayer'):
+                    world.player_ids[e[0]] = None
+
+            else:
+                if old[2] != e[2]:
+                    _unindex(world.entity_names, old[2], e[0])
+
+                if old[3] != e[3]:
+                    _unindex(world.place_index, old[3], e[0])
+
+            entities[e[0]] = e
+
+        for index, buckets in record['indexes'].items():
+            index = getattr(world, index)
+
+            for key, ids in buckets.items():
+                if ids:
+                    index[key] = dict.fromkeys(ids)
+
+                elif key in index:
+                    del index[key]
+
+        world.places.update(record['places'])
+
+        if 'paths' in record:
+            world._paths = [set(p) for p in record['paths']]
+            world.adjacency = record['adjacency']
+            world.pathfinder.invalidate()
+
+        world.rng.setstate(record['rng'])
+        world.ids.counter = record['ids']
+        world.tick_count = record['tick']
+        world.dormant = record['dormant']
+
+        asleep_since = record['asleep_since']
+        extra = record['extra']
+        applied += 1
+
+    if applied:
+        world._loaded = {}
+        world.rebuild_follow_index()
+        world._asleep_since = asleep_since
+
+        for name, state in extra.items():
+            provider = world.snapshot_providers.get(name)
+
+            if provider is not None:
+                provider[1](state)
+
+    return applied
+
+def recover(world, filename, snapshot_file):
+    """Brings a freshly loaded world back to where it was last
+    journaled: loads the snapshot, if any (opening it if mapped, see
+    mapped.open_world), then replays the journal, if any. Returns how
+    many journal records were replayed."""
+    if os.path.exists(snapshot_file):
+        if mapped.is_mapped(snapshot_file):
+            mapped.open_world(world, snapshot_file)
+
+        else:
+            snapshot.load(world, snapshot_file)
+
+    if not os.path.exists(filename):
+        return 0
+
+    return replay(world, filename)
@@ -0,0 +1,389 @@
+"""
+Memory-mapped world snapshots, for near-instant startup.
+
+Loading a regular snapshot (see snapshot.py) decodes the whole world up
+front, which takes seconds once it holds a million entities. A mapped
+snapshot holds the same state, laid out so that it can be mmap'ed and
+decoded bit by bit as the world gets used:
+
+* entities are stored in small chunks, in world order, along with a
+  hash table telling which chunk holds which ID; a chunk is decoded the
+  first time one of its entities is looked up or iteration gets to it;
+* the place index is stored ready to use, one place at a time, and the
+  name index one hash bucket at a time; each is decoded on first use.
+
+open_world swaps a world's entities and indexes for mappings backed by
+the file (see LazyTable), which behave like the dicts they replace,
+changes included. Whatever wasn't touched yet stays in the page cache
+instead of the process's own memory, so opening takes about as long
+whatever the size of the world.
+
+Level of detail (see GameWorld.lod_radius) keeps most of a large world
+untouched; without it, the first tick decodes every entity. So does
+anything else going over all of them, like taking a snapshot.
+
+Mapped snapshots are written from the frames snapshot.capture makes, so
+they can be autosaved like regular ones (freezing on the game's thread,
+writing in the background):
+
+    snapshot.Autosaver(world, 'world.smap', writer=mapped.write, chunk_size=mapped.CHUNK_SIZE)
+
+(capture's chunks are kept as they are, and smaller ones make for less
+decoding per entity looked up.)
+
+Like marshal itself, they are only meant to be read back by the Python
+version that wrote them.
+"""
+
+import gc
+import marshal
+import mmap
+import struct
+import zlib
+
+from collections.abc import MutableMapping
+
+from . import snapshot
+
+
+
+MAGIC = b'SMADMMAP'
+FORMAT_VERSION = 1
+CHUNK_SIZE = 256 # entities per chunk
+BUCKET_SIZE = 1024 # keys per hash bucket, on average
+
+# format version, marshal version, compressed, directory offset and length
+_HEADER = struct.Struct('<HHBQQ')
+
+
+def _bucket(key, buckets):
+    return zlib.crc32(key.encode('utf-8', 'surrogatepass')) % buckets
+
+def _hashed(pairs, count):
+    """Splits (key, value) pairs into dicts by hash bucket (see _bucket)."""
+    res = [{} for _ in range(max(1, count // BUCKET_SIZE))]
+    crc32 = zlib.crc32
+
+    for k, v in pairs:
+        res[crc32(k.encode('utf-8', 'surrogatepass')) % len(res)][k] = v
+
+    return res
+
+def write(frozen, fp, compress=False):
+    """Writes frames made by snapshot.capture to a binary file object,
+    laid out to be opened with open_world. fp must be seekable."""
+    start = fp.tell()
+
+    fp.write(MAGIC)
+    fp.write(_HEADER.pack(FORMAT_VERSION, marshal.version, bool(compress), 0, 0))
+
+    def put(data):
+        if compress:
+            data = zlib.compress(data, 1)
+
+        offset = fp.tell() - start
+        fp.write(data)
+
+        return (offset, len(data))
+
+    directory = {'chunks': []}
+    chunk_of = {} # entity ID -> chunk number
+
+    # (see snapshot.restore)
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+
+    try:
+        for kind, data in frozen:
+            kind, payload = marshal.loads(data)
+
+            if kind == 'entities':
+                # Kept as captured, frame and all.
+                n = len(directory['chunks'])
+
+                for e in payload:
+                    chunk_of[e[0]] = n
+
+                directory['chunks'].append(put(data))
+
+            elif kind == 'place_index':
+                directory['place_index'] = {p: put(marshal.dumps(ids)) for p, ids in payload.items()}
+
+            elif kind == 'entity_names':
+                directory['names'] = len(payload)
+                directory['entity_names'] = [put(marshal.dumps(b)) for b in _hashed(payload.items(), len(payload))]
+
+            elif kind != 'end':
+                directory[kind] = payload
+
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    directory['count'] = len(chunk_of)
+    directory['ids'] = [put(marshal.dumps(b)) for b in _hashed(chunk_of.items(), len(chunk_of))]
+
+    offset, length = put(marshal.dumps(directory))
+    end = fp.tell()
+
+    fp.seek(start + len(MAGIC))
+    fp.write(_HEADER.pack(FORMAT_VERSION, marshal.version, bool(compress), offset, length))
+    fp.seek(end)
+
+def write_file(frozen, filename, compress=False):
+    snapshot.write_file(frozen, filename, compress, writer=write)
+
+def save(world, filename, compress=False):
+    write_file(snapshot.capture(world, CHUNK_SIZE), filename, compress)
+
+def is_mapped(filename):
+    """Whether a file is a mapped snapshot (rather than a regular one)."""
+    with open(filename, 'rb') as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+class MappedFile(object):
+    """A mapped snapshot file, open for reading."""
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        with open(filename, 'rb') as fp:
+            self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a mapped world snapshot!")
+
+        version, marshal_version, self.compressed, offset, length = _HEADER.unpack_from(self.mm, len(MAGIC))
+
+        if version != FORMAT_VERSION:
+            raise ValueError("Unsupported mapped snapshot format version {} (expected {})!".format(version, FORMAT_VERSION))
+
+        if marshal_version > marshal.version:
+            raise ValueError("Snapshot written by a newer Python (marshal version {})!".format(marshal_version))
+
+        self.directory = self.load((offset, length))
+
+    def load(self, where):
+        """Decodes the blob at a given (offset, length)."""
+        offset, length = where
+        data = self.mm[offset:offset + length]
+
+        if self.compressed:
+            data = zlib.decompress(data)
+
+        return marshal.loads(data)
+
+
+class LazyTable(MutableMapping):
+    """A dict-like mapping whose initial content lives in a mapped
+    snapshot and is decoded as it is needed. Changes are only made in
+    memory. Iterates in the order a dict would: saved keys in saved
+    order, then keys added since.
+
+    Subclasses tell whether a key is among the saved ones (_saved),
+    decode them (_fetch, which stores at least the one asked for in
+    self._data through _decoded) and list them in order (_saved_keys)."""
+
+    def __init__(self, mapped, count):
+        self.mapped = mapped
+        self._count = count # saved entries
+        self._data = {} # live entries decoded or set so far
+        self._removed = set() # saved keys since removed
+        self._added = {} # ordered set of keys set that come after the saved ones
+
+    def _decoded(self, key, value):
+        if key not in self._data and key not in self._removed:
+            self._data[key] = value
+
+    def __getitem__(self, key):
+        try:
+            return self._data[key]
+
+        except KeyError:
+            if key in self._removed or not self._saved(key):
+                raise
+
+        self._fetch(key)
+
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data or (key not in self._removed and self._saved(key))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        if key not in self._data and (key in self._removed or not self._saved(key)):
+            self._added[key] = None
+
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+
+        self._data.pop(key, None)
+
+        if key in self._added:
+            del self._added[key]
+
+        else:
+            self._removed.add(key)
+
+    def __iter__(self):
+        removed = self._removed
+
+        for key in self._saved_keys():
+            if key not in removed:
+                yield key
+
+        yield from tuple(self._added)
+
+    def __len__(self):
+        return self._count - len(self._removed) + len(self._added)
+
+    def __repr__(self):
+        return '<{} of {} entries from {}>'.format(type(self).__name__, len(self), self.mapped.filename)
+
+
+class LazyEntities(LazyTable):
+    """Entity ID -> entity list, decoded a chunk at a time."""
+
+    def __init__(self, mapped):
+        super().__init__(mapped, mapped.directory['count'])
+
+        self._chunks = {} # chunk number -> IDs in it, once decoded
+        self._ids = {} # hash bucket number -> {entity ID: chunk number}, once decoded
+
+    def _chunk_of(self, eid):
+        if type(eid) is not str:
+            return None
+
+        buckets = self.mapped.directory['ids']
+        b = _bucket(eid, len(buckets))
+        ids = self._ids.get(b)
+
+        if ids is None:
+            ids = self._ids[b] = self.mapped.load(buckets[b])
+
+        return ids.get(eid)
+
+    def _saved(self, eid):
+        return self._chunk_of(eid) is not None
+
+    def _load_chunk(self, n):
+        ids = self._chunks.get(n)
+
+        if ids is None:
+            _, chunk = self.mapped.load(self.mapped.directory['chunks'][n]) # (still framed, see write)
+            ids = self._chunks[n] = [e[0] for e in chunk]
+
+            for e in chunk:
+                self._decoded(e[0], e)
+
+        return ids
+
+    def _fetch(self, eid):
+        self._load_chunk(self._chunk_of(eid))
+
+    def _saved_keys(self):
+        for n in range(len(self.mapped.directory['chunks'])):
+            yield from self._load_chunk(n)
+
+
+class LazyPlaceIndex(LazyTable):
+    """Place name -> ordered set (dict) of entity IDs, decoded a place
+    at a time."""
+
+    def __init__(self, mapped):
+        self._where = mapped.directory['place_index']
+
+        super().__init__(mapped, len(self._where))
+
+    def _saved(self, place):
+        return place in self._where
+
+    def _fetch(self, place):
+        self._decoded(place, dict.fromkeys(self.mapped.load(self._where[place])))
+
+    def _saved_keys(self):
+        return iter(self._where)
+
+
+class LazyNameIndex(LazyTable):
+    """Entity name -> ordered set (dict) of entity IDs, decoded a hash
+    bucket at a time. Iterates in bucket order."""
+
+    def __init__(self, mapped):
+        self._buckets = mapped.directory['entity_names']
+        self._names = {} # bucket number -> names in it, once decoded
+
+        super().__init__(mapped, mapped.directory['names'])
+
+    def _load_bucket(self, b):
+        names = self._names.get(b)
+
+        if names is None:
+            bucket = self.mapped.load(self._buckets[b])
+            names = self._names[b] = frozenset(bucket)
+
+            for name, ids in bucket.items():
+                self._decoded(name, dict.fromkeys(ids))
+
+        return names
+
+    def _saved(self, name):
+        return type(name) is str and name in self._load_bucket(_bucket(name, len(self._buckets)))
+
+    def _fetch(self, name):
+        pass # _saved decoded it already
+
+    def _saved_keys(self):
+        for b in range(len(self._buckets)):
+            yield from self._load_bucket(b)
+
+
+def open_world(world, filename):
+    """Replaces a world's state with the one in a mapped snapshot,
+    leaving entities and indexes to be decoded as they get used. Like
+    with snapshot.load, the world must have been loaded from the same
+    world file."""
+    # Places and paths still get decoded up front (see snapshot.restore).
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+
+    try:
+        mapped = MappedFile(filename)
+        paths = [set(p) for p in mapped.directory['paths']]
+
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    d = mapped.directory
+    meta = d['meta']
+
+    snapshot.restore_meta(world, meta)
+    world.places = d['places']
+
+    world._paths = paths
+    world.adjacency = d['adjacency']
+    world.pathfinder.invalidate()
+
+    world.entities = LazyEntities(mapped)
+    world.place_index = LazyPlaceIndex(mapped)
+    world.entity_names = LazyNameIndex(mapped)
+    world.player_ids = dict.fromkeys(meta['player_ids'])
+    world._loaded = {}
+    world._asleep_since = meta['asleep_since']
+    world.rebuild_follow_index()
+
+    snapshot.restore_extra(world, d['extra'])
+
+    return mapped
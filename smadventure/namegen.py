@@ -15,7 +15,7 @@ post_consonants = 'rhpzkltg'
 triple_consonants = ['str', 'spl', 'xpl']
 ditongs = ["ae", "ai", "ou", "ao", "oe", "oi", "oy", "aeo", "eio", "ee", "oo"]
 
-def generate_name(length, digraph_rate=0.3, ditong_rate=0.2, hyphen_rate=0.125):
+def generate_name(length, digraph_rate=0.3, ditong_rate=0.2, hyphen_rate=0.125, rng=random):
     if length <= 0:
         return False
 
@@ -24,7 +24,7 @@ def generate_name(length, digraph_rate=0.3, ditong_rate=0.2, hyphen_rate=0.125):
     
     while length > 0:
         if full_syl == '':
-            decision = random.choice(('consonant', 'vowel'))
+            decision = rng.choice(('consonant', 'vowel'))
 
         elif full_syl[-1:].lower() in vowels:
             decision = 'consonant'
@@ -32,28 +32,28 @@ def generate_name(length, digraph_rate=0.3, ditong_rate=0.2, hyphen_rate=0.125):
         elif full_syl[-1:].lower() in consonants:
             decision = 'vowel'
 
-        if random.random() <= hyphen_rate and len(full_syl) > 0 and len(full_syl.split('-')[-1]) > 2:
+        if rng.random() <= hyphen_rate and len(full_syl) > 0 and len(full_syl.split('-')[-1]) > 2:
             syl_choice = '-'
             
         elif decision == 'consonant':
-            if random.random() <= digraph_rate:
-                if random.random() <= 0.2:
-                    syl_choice = random.choice(triple_consonants)
+            if rng.random() <= digraph_rate:
+                if rng.random() <= 0.2:
+                    syl_choice = rng.choice(triple_consonants)
             
                 else:
-                    syl_choice = random.choice(pre_consonants) + random.choice(post_consonants)
+                    syl_choice = rng.choice(pre_consonants) + rng.choice(post_consonants)
                     # length -= 1
             
             else:
-                syl_choice = random.choice(consonants)
+                syl_choice = rng.choice(consonants)
             
         else:
-            if random.random() <= ditong_rate:
-                syl_choice = random.choice(ditongs)
+            if rng.random() <= ditong_rate:
+                syl_choice = rng.choice(ditongs)
                 # length -= 1
                 
             else:
-                syl_choice = random.choice(vowels)
+                syl_choice = rng.choice(vowels)
 
         full_syl += syl_choice
         length -= len(syl_choice)
@@ -0,0 +1,236 @@
+"""
+Batched, rate limited delivery of broadcasts to chat.
+
+An Outbox is a broadcast channel standing for one destination (a chat
+channel, a player...). Instead of sending every broadcast as its own
+line, it collects them, then:
+
+* merges repeated messages of the same tick, e.g. five sheep wandering
+  to the same place become "5 Sheep wander to North Bridge.";
+* packs what is left into digest lines of bounded length;
+* sends those lines no faster than its backend's TokenBucket allows,
+  events (BCAST_EVENT and up) first, then important ones
+  (BCAST_IMPORTANT and up), then the rest.
+
+Register one like any other channel; GameWorld._broadcast_loop runs it:
+
+    world.add_broadcast_channel(engine.BCAST_INFO, Outbox(chan.reply, bucket))
+"""
+
+import logging
+import trio
+
+from collections import deque
+
+from . import engine
+from .common import plural, plural_verb
+
+
+
+DEFAULT_RATE = 1.0 # lines per second
+DEFAULT_BURST = 4
+DEFAULT_LINE_LENGTH = 400
+DEFAULT_BACKLOG = 50 # lines
+
+
+class TokenBucket(object):
+    """Allows rate operations per second on average, and up to burst
+    of them at once. Share one between every Outbox sending through
+    the same backend."""
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = None
+
+    def _refill(self):
+        now = trio.current_time()
+
+        if self.last is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+
+        self.last = now
+
+    async def take(self):
+        self._refill()
+
+        while self.tokens < 1:
+            await trio.sleep((1 - self.tokens) / self.rate)
+            self._refill()
+
+        self.tokens -= 1
+
+def priority(level):
+    if level >= engine.BCAST_EVENT:
+        return 2
+
+    if level >= engine.BCAST_IMPORTANT:
+        return 1
+
+    return 0
+
+def _template(message):
+    """The key under which messages can be merged: their text, with
+    entities standing as their variant."""
+    return tuple(
+        (None, p.type.id, p.spl[4]) if isinstance(p, engine.LoadedEntity) else str(p)
+        for p in message
+    )
+
+def render(messages):
+    """Renders messages sharing a template as a single line. Where they
+    differ in entity, it is replaced by a count (and, if it is what the
+    sentence is about, the verb after it made plural); exact repetitions
+    get a multiplier."""
+    first = messages[0]
+
+    if len(messages) == 1:
+        return ''.join(str(p) for p in first)
+
+    res = ''
+    varied = False
+    subject = 1 # count of the entity just merged, if it starts a sentence
+
+    for i, p in enumerate(first):
+        if isinstance(p, engine.LoadedEntity):
+            ids = {m[i].id for m in messages}
+
+            if len(ids) > 1:
+                # (e.g. "2 Miners attack", but "Miner attacks 2 Hornets")
+                starts = not res.strip() or res.rstrip()[-1] in '.!?*'
+
+                res += '{} {}'.format(len(ids), plural(p.variant['name'], len(ids)))
+                varied = True
+                subject = len(ids) if starts else 1
+                continue
+
+        elif subject > 1:
+            p = plural_verb(str(p), subject)
+
+        subject = 1
+        res += str(p)
+
+    if not varied:
+        res += ' (x{})'.format(len(messages))
+
+    return res
+
+
+class Outbox(object):
+    """Collects broadcasts for one destination and sends them, merged
+    and rate limited, through send (an async function taking a line).
+
+    Messages are grouped by the tick they were broadcast in; lines never
+    mix ticks. linger is how long to wait for the rest of a tick's
+    messages before composing lines, when nothing is waiting to be sent
+    already. Past backlog lines waiting, the oldest of the least
+    important ones are dropped."""
+
+    def __init__(self, send, bucket=None, line_length=DEFAULT_LINE_LENGTH, backlog=DEFAULT_BACKLOG, linger=0.25, separator=' | '):
+        self.send = send
+        self.bucket = bucket
+        self.line_length = line_length
+        self.backlog = backlog
+        self.linger = linger
+        self.separator = separator
+
+        self.dropped = 0
+        self.running = False
+
+        self._pending = [] # (tick, level, message parts)
+        self._lines = (deque(), deque(), deque()) # by priority
+        self._wakeup = trio.Event()
+        self._scope = None
+
+    def put(self, message, place, level, tick):
+        """Called by the broadcast loop for every broadcast this
+        channel hears."""
+        self._pending.append((tick, level, message))
+        self._wakeup.set()
+
+    async def __call__(self, m, place, level):
+        # Plain text, e.g. from a 'to' broadcast; still batched.
+        self.put((m,), place, level, None)
+
+    def _compose(self):
+        groups = {}
+
+        for tick, level, message in self._pending:
+            groups.setdefault((priority(level), tick), {}).setdefault(_template(message), []).append(message)
+
+        self._pending = []
+
+        for (prio, tick), templates in groups.items():
+            queue = self._lines[prio]
+            line = ''
+
+            for messages in templates.values():
+                text = render(messages)
+
+                if line and len(line) + len(self.separator) + len(text) > self.line_length:
+                    queue.append(line)
+                    line = text
+
+                else:
+                    line = line + self.separator + text if line else text
+
+            if line:
+                queue.append(line)
+
+        excess = self.queued() - self.backlog
+
+        for queue in self._lines:
+            while excess > 0 and queue:
+                queue.popleft()
+                self.dropped += 1
+                excess -= 1
+
+    def queued(self):
+        """How many lines are waiting to be sent."""
+        return sum(len(q) for q in self._lines)
+
+    def _next_line(self):
+        for queue in reversed(self._lines):
+            if queue:
+                return queue.popleft()
+
+        return None
+
+    async def run(self):
+        self.running = True
+
+        try:
+            with trio.CancelScope() as self._scope:
+                while True:
+                    if not (self._pending or self.queued()):
+                        await self._wakeup.wait()
+
+                    self._wakeup = trio.Event()
+
+                    if self._pending and not self.queued():
+                        await trio.sleep(self.linger)
+
+                    if self._pending:
+                        self._compose()
+
+                    line = self._next_line()
+
+                    if line is None:
+                        continue
+
+                    if self.bucket is not None:
+                        await self.bucket.take()
+
+                    try:
+                        await self.send(line)
+
+                    except Exception:
+                        logging.exception("Could not send a broadcast line")
+
+        finally:
+            self.running = False
+
+    def close(self):
+        if self._scope is not None:
+            self._scope.cancel()
@@ -0,0 +1,134 @@
+import heapq
+
+
+
+class Pathfinder(object):
+    """Danger-aware route finding over a GameWorld's adjacency graph.
+
+    Creatures prefer to avoid places full of things that could eat them.
+    The danger of a place depends on who is asking, so costs are kept
+    per faction, a (entity type ID, is mush) pair. Each place's cost is
+    computed at most once per faction until invalidate() is called,
+    which GameWorld does at the start of every tick and whenever paths
+    change.
+
+    Routes are searched backwards from the destination, so a single
+    search tree serves every creature heading to the same place. The
+    search is resumable: it only expands as far as the origins asked
+    about so far require."""
+
+    def __init__(self, world):
+        self.world = world
+
+        self._danger = {} # faction -> {place: cost}
+        self._trees = {} # (destination, faction) -> _RouteTree
+
+    @staticmethod
+    def faction_of(entity):
+        return (entity.type.id, bool(entity['mush']))
+
+    def invalidate(self):
+        self._danger = {}
+        self._trees = {}
+
+    def danger(self, place, faction):
+        """The cost of stepping into a place, as seen by a faction."""
+        costs = self._danger.setdefault(faction, {})
+        cost = costs.get(place)
+
+        if cost is None:
+            etype, mush = faction
+            cost = 1
+
+            for a in self.world.all_in_place(place):
+                if not (a['mush'] and mush) and a.type.id != etype:
+                    cost += a['dangerousness'] + a['health']
+
+            costs[place] = cost
+
+        return cost
+
+    def _tree(self, dest, faction):
+        key = (dest, faction)
+        tree = self._trees.get(key)
+
+        if tree is None:
+            tree = self._trees[key] = _RouteTree(self, dest, faction)
+
+        return tree
+
+    def next_step(self, origin, dest, faction):
+        """Returns the next place to move to in order to get from
+        origin to dest, or None if there is no such path."""
+        if origin == dest:
+            return None
+
+        return self._tree(dest, faction).next_hop(origin)
+
+    def route(self, origin, dest, faction):
+        """Returns the full list of places to step through from
+        origin to dest (origin excluded), or None if unreachable."""
+        if origin == dest:
+            return []
+
+        tree = self._tree(dest, faction)
+
+        if tree.next_hop(origin) is None:
+            return None
+
+        res = []
+        cur = origin
+
+        while cur != dest:
+            cur = tree.hops[cur]
+            res.append(cur)
+
+        return res
+
+
+class _RouteTree(object):
+    """A lazily grown shortest path tree rooted at a destination."""
+
+    def __init__(self, pathfinder, dest, faction):
+        self.pathfinder = pathfinder
+        self.faction = faction
+
+        self.dist = { dest: 0 }
+        self.hops = { dest: None }
+        self.settled = set()
+
+        self._counter = 0
+        self._open = [(0, 0, dest)]
+
+    def next_hop(self, origin):
+        world = self.pathfinder.world
+        danger = self.pathfinder.danger
+
+        while origin not in self.settled and self._open:
+            d, _, cur = heapq.heappop(self._open)
+
+            if cur in self.settled:
+                continue
+
+            self.settled.add(cur)
+
+            # Stepping from a neighbour into cur costs cur's danger.
+            step = danger(cur, self.faction)
+
+            for n in world.neighbors(cur):
+                if n in self.settled:
+                    continue
+
+                nd = d + step
+
+                if n not in self.dist or nd < self.dist[n]:
+                    self.dist[n] = nd
+                    self.hops[n] = cur
+                    self._counter += 1
+
+                    heapq.heappush(self._open, (nd, self._counter, n))
+
+        if origin not in self.settled:
+            return None
+
+        return self.hops[origin]
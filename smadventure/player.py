@@ -49,8 +49,6 @@ class PlayerInterface(object):
 
     @classmethod
     def join(self, world, name, place, type, variant):
-        entity = world.etypes[type].instantiate(world, place, variant, name)
-        world.add_entity(entity)
-        entity = world.from_ent(entity)
+        entity = world.spawn_many(type, place, variant, 1, names=[name])[0]
 
         return PlayerInterface(entity, name)
@@ -7,7 +7,7 @@ import triarc.backends.discord
 import trio
 import trio_asyncio
 
-from . import interface
+from . import interface, mapped, snapshot
 
 
 
@@ -23,7 +23,17 @@ def main():
     logger.addHandler(logging.FileHandler('last.log', 'w'))
 
     main_cfg = yaml.safe_load(open("config/main.yml"))
-    bot, world = interface.make_game(main_cfg['gamefile'], main_cfg['prefix'])
+    bot, world = interface.make_game(
+        main_cfg['gamefile'], main_cfg['prefix'],
+        lod_radius=main_cfg.get('lod_radius', None),
+        seed=main_cfg.get('seed', None),
+        command_log=main_cfg.get('command_log', None),
+        snapshot_file=main_cfg.get('snapshot', None),
+        journal_file=main_cfg.get('journal', None),
+        bundle_file=main_cfg.get('bundle', None),
+        streaming_load=main_cfg.get('streaming_load', False),
+        hot_reload=main_cfg.get('hot_reload', None)
+    )
 
     for s in yaml.safe_load(open("config/irc.yml")):
         print('Opening IRC connection: ', s['name'])
@@ -61,4 +71,17 @@ def main():
             nursery.start_soon(world._broadcast_loop)
             nursery.start_soon(bot.start)
 
+            if bot.reloader is not None:
+                nursery.start_soon(bot.reloader.run)
+
+            # (a journal takes its own snapshots)
+            if main_cfg.get('snapshot', None) and main_cfg.get('autosave_interval', None) and world.journal is None:
+                if main_cfg.get('mapped_snapshot', False):
+                    saver = snapshot.Autosaver(world, main_cfg['snapshot'], main_cfg['autosave_interval'], False, mapped.write, mapped.CHUNK_SIZE)
+
+                else:
+                    saver = snapshot.Autosaver(world, main_cfg['snapshot'], main_cfg['autosave_interval'])
+
+                nursery.start_soon(saver.run)
+
     trio_asyncio.run(smadv_main)
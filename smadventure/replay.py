@@ -0,0 +1,89 @@
+"""
+Session recording and replay.
+
+A world's random streams are all derived from its seed (see rng.py),
+so the seed plus every player command, in order, is enough to play a
+session back exactly. make_game records both into a command log when
+asked to (see 'command_log' in config/main.example.yml); replay it with:
+
+    python -m smadventure.replay session.jsonl
+"""
+
+try:
+    import simplejson as json
+
+except ImportError:
+    import json
+
+import hashlib
+import sys
+import trio
+
+
+
+class CommandLog(object):
+    """Writes a session's seed and player commands as JSON lines.
+    The first line is a header describing the world; every other line
+    is a command, stamped with the tick it was issued at."""
+
+    def __init__(self, fp, world_file, seed, lod_radius=None):
+        self.fp = fp
+
+        self._write({
+            'world': world_file,
+            'seed': seed,
+            'lod_radius': lod_radius,
+        })
+
+    def _write(self, record):
+        self.fp.write(json.dumps(record) + '\n')
+        self.fp.flush()
+
+    def record(self, tick, backend, addr, author, command, args):
+        self._write({
+            'tick': tick,
+            'backend': backend,
+            'addr': addr,
+            'author': author,
+            'command': command,
+            'args': list(args),
+        })
+
+    def close(self):
+        self.fp.close()
+
+def read_log(filename):
+    """Returns the header and the list of commands of a command log."""
+    with open(filename) as fp:
+        lines = [json.loads(l) for l in fp if l.strip()]
+
+    if not lines:
+        raise ValueError("Empty command log: {}".format(filename))
+
+    return lines[0], lines[1:]
+
+def world_digest(world):
+    """A digest of every entity's state, for telling whether two runs
+    ended up in the same place."""
+    h = hashlib.sha1()
+
+    for e in world.entities.values():
+        h.update(repr((e[0], e[1], e[2], e[3], e[4], sorted((repr(k), repr(v)) for k, v in e[5].items()))).encode('utf-8'))
+
+    return h.hexdigest()
+
+def main(argv=None):
+    from . import interface
+
+    argv = sys.argv[1:] if argv is None else argv
+
+    if len(argv) != 1:
+        print("Usage: python -m smadventure.replay <command log>")
+        return 1
+
+    bot, world = trio.run(interface.replay_session, argv[0])
+
+    print("Replayed up to tick {}: {} entities, state digest {}.".format(world.tick_count, len(world.entities), world_digest(world)))
+
+if __name__ == '__main__':
+    sys.exit(main())
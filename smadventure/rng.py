@@ -0,0 +1,121 @@
+"""
+Seeded random number service.
+
+Each GameWorld owns a RandomService (world.rng), which hands out one
+independent random stream per subsystem, all derived from a single
+seed. Scripts should draw from the stream fitting what they do:
+
+    entity.world.rng.ai.random()
+    entity.world.rng.combat.uniform(20, 35)
+
+Given the same seed (and the same player commands, see replay.py), a
+world evolves exactly the same way every time.
+"""
+
+try:
+    import numpy
+
+except ImportError:
+    numpy = None
+
+import hashlib
+import random
+
+
+STREAMS = ('ai', 'combat', 'spawning', 'names')
+
+
+def derive_seed(seed, name):
+    """A 64-bit seed for a named stream, stable across runs and
+    processes (unlike hash(), which is salted per process)."""
+    digest = hashlib.sha256('{}:{}'.format(seed, name).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'little')
+
+
+class RandomStream(random.Random):
+    """A random.Random with its own seed, plus a NumPy generator (when
+    available) seeded alongside it for batched draws.
+
+    Scalar draws (random, uniform, randint, choice...) stay on the C
+    Mersenne Twister behind random.Random: serving them from batches in
+    Python turned out slower than that. Code drawing many values at
+    once, like the bulk column systems, should use floats() or numpy()
+    instead."""
+
+    def __init__(self, seed):
+        self._gen = None
+
+        super().__init__(seed)
+
+    def seed(self, a=None, version=2):
+        super().seed(a, version)
+
+        if numpy is not None and isinstance(a, int):
+            self._gen = numpy.random.default_rng(a)
+
+        else:
+            self._gen = None
+
+    def floats(self, count):
+        """count floats in [0, 1), as a NumPy array if NumPy is
+        available, or a list otherwise."""
+        if self._gen is not None:
+            return self._gen.random(count)
+
+        return [self.random() for _ in range(count)]
+
+    def numpy(self):
+        """The NumPy generator behind this stream, for vectorized code;
+        None without NumPy."""
+        return self._gen
+
+    def getstate(self):
+        return (super().getstate(), self._gen.bit_generator.state if self._gen is not None else None)
+
+    def setstate(self, state):
+        base, gen = state
+
+        super().setstate(base)
+
+        if gen is not None and numpy is not None:
+            # Set in place; the column store holds on to this generator.
+            if self._gen is None:
+                self._gen = numpy.random.default_rng()
+
+            self._gen.bit_generator.state = gen
+
+
+class RandomService(object):
+    """Owns a world's random streams.
+
+    The streams are reachable as attributes (rng.ai, rng.combat,
+    rng.spawning, rng.names), or by name through stream(), which also
+    creates streams for names not listed in STREAMS. If no seed is
+    given, one is picked at random; either way, it is kept in
+    self.seed, so the session can be replayed."""
+
+    def __init__(self, seed=None):
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(64)
+
+        self.seed = seed
+        self.streams = {}
+
+        for name in STREAMS:
+            self.stream(name)
+
+    def stream(self, name):
+        s = self.streams.get(name)
+
+        if s is None:
+            s = self.streams[name] = RandomStream(derive_seed(self.seed, name))
+            setattr(self, name, s)
+
+        return s
+
+    def getstate(self):
+        return { name: s.getstate() for name, s in self.streams.items() }
+
+    def setstate(self, state):
+        for name, s in state.items():
+            self.stream(name).setstate(s)
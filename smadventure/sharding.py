@@ -0,0 +1,495 @@
+"""
+Multi-process world sharding.
+
+A ShardedWorld splits the places of a world across worker processes,
+each ticking its own ShardWorld. Between ticks, the coordinator (the
+process that created the ShardedWorld) routes everything that crosses a
+shard boundary over pipes:
+
+* entities that moved into another shard's place migrate to it;
+* broadcasts are forwarded to the coordinator's front world, where the
+  usual broadcast channels pick them up;
+* pointers to entities living in other shards (targets, friends,
+  partners) resolve, through a location directory, to ghost copies of
+  them as of the previous tick. Writes to ghosts are forwarded to the
+  owning shard and applied at the start of its next tick.
+
+Ghosts are requested on first use and arrive a couple of ticks later;
+until then, such pointers resolve to None, as if the entity had left.
+
+This is incomplete: nothing in the game can run sharded yet. make_game,
+program.py and the config have no option for it, because player
+commands (see interface.py) read and change entities in the world they
+are given directly, and here those live in the shard processes, not in
+the front world. Until commands are routed to the shard owning their
+player, a ShardedWorld can only be driven from code, e.g. to measure
+it, which looks like:
+
+    sw = ShardedWorld('mushworld.xml', shards=4)
+    sw.world.add_broadcast_channel(2, some_channel)
+
+    # in a trio task, alongside sw.world._broadcast_loop:
+    await sw.tick()
+
+    sw.stop()
+"""
+
+import multiprocessing
+import trio
+
+from collections import deque
+
+from . import engine, rng
+
+
+
+def partition(world, shards, shard_map=None):
+    """Assigns every place of a world to a shard, returning a dict of
+    place name -> shard index.
+
+    Places named in shard_map keep the shard given there. Every other
+    place is grouped by connected region of the path graph; regions
+    are handed to the least loaded shard, largest first, and regions
+    heavier than a fair share are cut into chunks along breadth-first
+    order, which keeps each chunk mostly contiguous."""
+    owner = {}
+    load = [0] * shards
+
+    def weight(p):
+        return 1 + len(world.place_index.get(p, ()))
+
+    if shard_map:
+        for p, s in shard_map.items():
+            if p in world.places:
+                owner[p] = int(s) % shards
+                load[owner[p]] += weight(p)
+
+    rest = [p for p in world.places if p not in owner]
+    rest_set = set(rest)
+    seen = set()
+    regions = []
+
+    for p in rest:
+        if p in seen:
+            continue
+
+        region = []
+        queue = deque([p])
+        seen.add(p)
+
+        while queue:
+            cur = queue.popleft()
+            region.append(cur)
+
+            for n in world.neighbors(cur):
+                if n in rest_set and n not in seen:
+                    seen.add(n)
+                    queue.append(n)
+
+        regions.append(region)
+
+    share = max(1, sum(weight(p) for p in rest) / shards)
+
+    def assign(chunk, w):
+        s = min(range(shards), key=lambda i: load[i])
+
+        for p in chunk:
+            owner[p] = s
+
+        load[s] += w
+
+    for region in sorted(regions, key=lambda r: sum(weight(p) for p in r), reverse=True):
+        chunk = []
+        w = 0
+
+        for p in region:
+            chunk.append(p)
+            w += weight(p)
+
+            if w >= share:
+                assign(chunk, w)
+                chunk = []
+                w = 0
+
+        if chunk:
+            assign(chunk, w)
+
+    return owner
+
+def _plain(e):
+    """A picklable copy of an entity list."""
+    return [e[0], e[1], e[2], e[3], e[4], dict(e[5])]
+
+
+class GhostEntity(engine.LoadedEntity):
+    """A local, possibly stale copy of an entity owned by another shard.
+    Reads work as usual; changes apply to the copy and are forwarded
+    to the owner."""
+
+    __slots__ = ()
+
+    def _forward(self, *op):
+        self.world._outbox['writes'].append(op)
+
+    def __setitem__(self, key, val):
+        if self.despawned:
+            return
+
+        self.attr[key] = val
+        self._forward('set', self.id, key, val)
+
+    def pop(self, key, default=None):
+        if self.despawned:
+            return
+
+        self._forward('pop', self.id, key)
+        return self.attr.pop(key, default)
+
+    @property
+    def place(self):
+        return self.spl[3]
+
+    @place.setter
+    def place(self, val):
+        self.spl[3] = val
+        self._forward('place', self.id, val)
+
+    def set_variant(self, variant):
+        super().set_variant(variant)
+        self._forward('variant', self.id, variant)
+
+    def set_name(self, name):
+        if self.despawned:
+            return
+
+        self.spl[2] = name
+        self._forward('name', self.id, name)
+
+    def despawn(self):
+        self.despawned = True
+        self._forward('despawn', self.id)
+
+
+class ShardWorld(engine.GameWorld):
+    """The part of a world a shard worker simulates. Also knows where
+    every other entity lives, so it can resolve cross-shard pointers."""
+
+    def __init__(self, *args, **kwargs):
+        self.shard = None
+        self.owner = {} # place name -> shard index
+        self.directory = {} # entity ID -> shard index
+        self.ghosts = {} # entity ID -> entity list copy
+        self._ghost_wrappers = {}
+        self._emigrating = False
+        self._outbox = self._new_outbox()
+        self._forward_level = float('-inf') # lowest level the front world listens to
+
+        super().__init__(*args, **kwargs)
+
+    @staticmethod
+    def _new_outbox():
+        return {
+            'emigrants': [],
+            'arrived': [],
+            'removed': [],
+            'writes': [],
+            'wanted': set(),
+            'exports': {},
+            'broadcasts': [],
+        }
+
+    def broadcast(self, level, *message, place=None, to=None):
+        # Nobody on the front world would hear it; don't even bother
+        # rendering it (see GameWorld.broadcast).
+        if level < self._forward_level:
+            return
+
+        if isinstance(place, str):
+            place = {place}
+
+        self._outbox['broadcasts'].append((level, ''.join(str(n) for n in message), place))
+
+    def from_id(self, eid):
+        e = super().from_id(eid)
+
+        if e is not None or eid is None or eid in self.entities:
+            return e
+
+        if self.directory.get(eid, self.shard) == self.shard:
+            return None
+
+        self._outbox['wanted'].add(eid)
+        g = self.ghosts.get(eid)
+
+        if g is None:
+            return None
+
+        ghost = self._ghost_wrappers.get(eid)
+
+        if ghost is None or ghost.spl is not g:
+            ghost = self._ghost_wrappers[eid] = GhostEntity(self, g)
+
+        if ghost.despawned:
+            return None
+
+        return ghost
+
+    def _add_entities_now(self, es, init=True):
+        es = list(es)
+        self._outbox['arrived'].extend(e[0] for e in es)
+
+        return super()._add_entities_now(es, init)
+
+    def remove_entity(self, eid):
+        if not self._emigrating and eid in self.entities:
+            self._outbox['removed'].append(eid)
+
+        super().remove_entity(eid)
+
+    def apply_inbound(self, data):
+        self._forward_level = data['forward_level']
+
+        for eid, s in data['directory'].items():
+            if s is None:
+                self.directory.pop(eid, None)
+                self.ghosts.pop(eid, None)
+                self._ghost_wrappers.pop(eid, None)
+
+            else:
+                self.directory[eid] = s
+
+        self.places.update(data['places'])
+        self.ghosts.update(data['ghosts'])
+
+        for op in data['writes']:
+            self._apply_write(op)
+
+        if data['adopt']:
+            self.add_entities(data['adopt'], init=False)
+
+        for eid in data['export']:
+            e = self.entities.get(eid)
+
+            if e is not None:
+                self._outbox['exports'][eid] = _plain(e)
+
+    def _apply_write(self, op):
+        kind, eid = op[0], op[1]
+        e = engine.GameWorld.from_id(self, eid)
+
+        if e is None:
+            if eid not in self.entities:
+                # Moved on to yet another shard; let the coordinator reroute it.
+                self._outbox['writes'].append(op)
+
+            return
+
+        if kind == 'set':
+            e[op[2]] = op[3]
+
+        elif kind == 'pop':
+            e.pop(op[2])
+
+        elif kind == 'place':
+            e.set_place(op[2])
+
+        elif kind == 'variant':
+            e.set_variant(op[2])
+
+        elif kind == 'name':
+            e.set_name(op[2])
+
+        elif kind == 'despawn':
+            self.remove_entity(eid)
+
+    def collect_outbound(self):
+        """Sends every entity standing in another shard's place away,
+        then returns (and resets) everything the coordinator needs to
+        hear about since the last call."""
+        for place in tuple(self.place_index):
+            if self.owner.get(place, self.shard) == self.shard:
+                continue
+
+            for eid in tuple(self.place_index.get(place, ())):
+                e = self.entities[eid]
+
+                self._emigrating = True
+
+                try:
+                    self.remove_entity(eid)
+
+                finally:
+                    self._emigrating = False
+
+                self._outbox['emigrants'].append(_plain(e))
+
+        res = self._outbox
+        res['wanted'] = list(res['wanted'])
+
+        self._outbox = self._new_outbox()
+
+        return res
+
+
+def _shard_main(conn, world_file, shard, owner, seed):
+    world = engine.XMLGameLoader().load_world(world_file, populate=False, world_class=ShardWorld, seed=seed)
+    world.shard = shard
+    world.owner = owner
+
+    while True:
+        cmd, data = conn.recv()
+
+        if cmd == 'stop':
+            break
+
+        if cmd == 'tick':
+            world.apply_inbound(data)
+            trio.run(world.tick)
+
+            conn.send(('ticked', world.collect_outbound()))
+
+    conn.close()
+
+
+class ShardedWorld(object):
+    """Coordinates a world split across worker processes.
+
+    The world file is loaded (and populated) once here; its entities
+    are then handed out to the shards, leaving self.world as an empty
+    front world whose broadcast channels receive every shard's
+    broadcasts. Not usable by the game yet; see the module's
+    description."""
+
+    def __init__(self, world_file, shards=2, shard_map=None, world=None, seed=None):
+        if world is None:
+            world = engine.XMLGameLoader().load_world(world_file, seed=seed)
+
+        self.world = world
+        self.owner = partition(world, shards, shard_map)
+        self.directory = {} # entity ID -> shard index
+
+        self._wanted_by = {} # entity ID -> shards waiting for a ghost of it
+        self._next = [self._new_inbound() for _ in range(shards)]
+
+        for eid, e in world.entities.items():
+            s = self.owner.get(e[3], 0)
+
+            self._next[s]['adopt'].append(_plain(e))
+            self.directory[eid] = s
+
+        for eid in tuple(world.entities):
+            world.remove_entity(eid)
+
+        for s, inbound in enumerate(self._next):
+            inbound['directory'] = dict(self.directory)
+            inbound['places'] = {p: v for p, v in world.places.items() if self.owner.get(p) == s}
+
+        ctx = multiprocessing.get_context('spawn')
+
+        self.conns = []
+        self.processes = []
+
+        for s in range(shards):
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(target=_shard_main, args=(child, world_file, s, self.owner, rng.derive_seed(world.rng.seed, 'shard-{}'.format(s))), name='smadventure-shard-{}'.format(s), daemon=True)
+            proc.start()
+
+            self.conns.append(parent)
+            self.processes.append(proc)
+
+    @staticmethod
+    def _new_inbound():
+        return {
+            'adopt': [],
+            'writes': [],
+            'directory': {},
+            'places': {},
+            'ghosts': {},
+            'export': [],
+            'forward_level': float('-inf'),
+        }
+
+    async def tick(self):
+        for conn, inbound in zip(self.conns, self._next):
+            inbound['forward_level'] = self.world._min_broadcast_level
+            conn.send(('tick', inbound))
+
+        self._next = [self._new_inbound() for _ in self.conns]
+        replies = [None] * len(self.conns)
+
+        async def _receive(s):
+            replies[s] = (await trio.to_thread.run_sync(self.conns[s].recv))[1]
+
+        async with trio.open_nursery() as nursery:
+            for s in range(len(self.conns)):
+                nursery.start_soon(_receive, s)
+
+        self._route(replies)
+
+    def _route(self, replies):
+        delta = {}
+
+        for s, out in enumerate(replies):
+            for eid in out['removed']:
+                if self.directory.get(eid) == s:
+                    del self.directory[eid]
+                    delta[eid] = None
+
+            for eid in out['arrived']:
+                self.directory[eid] = s
+                delta[eid] = s
+
+        for s, out in enumerate(replies):
+            for e in out['emigrants']:
+                dest = self.owner.get(e[3], s)
+
+                self._next[dest]['adopt'].append(e)
+                self.directory[e[0]] = dest
+                delta[e[0]] = dest
+
+        for s, out in enumerate(replies):
+            for eid in out['wanted']:
+                self._wanted_by.setdefault(eid, set()).add(s)
+
+        for s, out in enumerate(replies):
+            for op in out['writes']:
+                dest = self.directory.get(op[1])
+
+                if dest is not None:
+                    self._next[dest]['writes'].append(op)
+
+            for eid, copy in out['exports'].items():
+                for r in self._wanted_by.pop(eid, ()):
+                    self._next[r]['ghosts'][eid] = copy
+
+            for level, message, place in out['broadcasts']:
+                self.world.broadcast(level, message, place=place)
+
+        # Shards answer export requests within the tick they get them,
+        # so whatever is still wanted is either new, or was asked of a
+        # shard the entity left (or died in) meanwhile. Ask wherever it
+        # lives now, unless that's where it is wanted.
+        for eid, wanters in tuple(self._wanted_by.items()):
+            dest = self.directory.get(eid)
+            wanters.discard(dest)
+
+            if dest is None or not wanters:
+                del self._wanted_by[eid]
+
+            else:
+                self._next[dest]['export'].append(eid)
+
+        if delta:
+            for inbound in self._next:
+                inbound['directory'].update(delta)
+
+    def locate(self, eid):
+        """Returns the index of the shard an entity lives in, or None."""
+        return self.directory.get(eid)
+
+    def stop(self):
+        for conn in self.conns:
+            conn.send(('stop', None))
+
+        for proc in self.processes:
+            proc.join()
@@ -0,0 +1,138 @@
+"""
+Streaming world loading, for very large (e.g. generated) world files.
+
+XMLGameLoader reads the whole world document into a tree before doing
+anything with it, so its memory use grows with the file. The
+StreamingGameLoader parses it incrementally instead, adding (and
+populating) each place and path as soon as its element is complete,
+then freeing the element.
+
+Entity type files are independent of each other, so they are parsed
+and compiled concurrently by a pool of worker processes. Each worker
+hands back its entity type frozen like in a bundle (see bundle.freeze),
+and the results are merged into the world in the order the world file
+lists them, so worlds come out the same as XMLGameLoader's for a given
+seed.
+"""
+
+import logging
+import marshal
+import multiprocessing
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from xml.parsers import expat
+
+from . import bundle, embedcode, engine
+
+
+
+def read_header(filename):
+    """Returns a world file's beginning and the entity type files it
+    lists, without building any of its elements."""
+    beginning = None
+    etype_files = []
+
+    def start(tag, attrib):
+        nonlocal beginning
+
+        if tag == 'world':
+            beginning = attrib.get('beginning')
+
+        elif tag == 'etype':
+            etype_files.append(attrib.get('filename'))
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start
+
+    with open(filename, 'rb') as fp:
+        parser.ParseFile(fp)
+
+    return beginning, etype_files
+
+def iter_elements(filename, tags):
+    """Yields every element of an XML file with one of the given tags
+    as soon as it is complete. Completed elements are freed as parsing
+    goes, save for those inside a wanted one."""
+    stack = []
+    wanted = 0 # wanted elements in the stack
+
+    for event, el in engine.etree.iterparse(filename, events=('start', 'end')):
+        if event == 'start':
+            stack.append(el)
+            wanted += el.tag in tags
+            continue
+
+        stack.pop()
+
+        if el.tag in tags:
+            wanted -= 1
+            yield el
+
+        if stack and not wanted:
+            stack[-1].remove(el)
+
+
+class StreamingGameLoader(engine.XMLGameLoader):
+    """Loads worlds without ever holding the whole world document in
+    memory; see the module's description.
+
+    workers is the size of the process pool compiling entity types: by
+    default, one per CPU (or per entity type file, if fewer). With 0,
+    they are compiled one at a time in this process instead, which is
+    quicker for a handful of small files."""
+
+    def __init__(self, workers=None):
+        super().__init__()
+
+        self.workers = workers
+
+    def load_world(self, filename, populate=True, world_class=None, seed=None):
+        # Entity types must be known before places can be populated,
+        # yet world files may list them last; a first pass picks them
+        # up without keeping anything else.
+        beginning, etype_files = read_header(filename)
+
+        self.sources[filename] = None
+
+        world = (world_class or engine.GameWorld)(beginning=beginning, seed=seed)
+
+        logging.info("Loading entity types...")
+
+        holder = embedcode.CodeHolder(cache_dir=None)
+
+        for frozen in self.compile_etypes(etype_files):
+            content = marshal.loads(frozen)
+
+            self.sources.update(dict.fromkeys(content['sources']))
+            bundle.instantiate(world, content, holder)
+
+        logging.info("Loading and populating places...")
+
+        for el in iter_elements(filename, ('place', 'path')):
+            if el.tag == 'place':
+                self.build_place(world, el.get('name'), self.read_place(el), populate)
+
+            else:
+                world.add_path(el.get('ends').split(';'))
+
+        logging.info("World loaded!")
+
+        return world
+
+    def compile_etypes(self, filenames):
+        """Yields every entity type file compiled by bundle.compile_etype,
+        in order."""
+        workers = self.workers
+
+        if workers is None:
+            workers = min(len(filenames), os.cpu_count() or 1)
+
+        if workers <= 1 or len(filenames) <= 1:
+            for fn in filenames:
+                yield bundle.compile_etype(fn)
+
+            return
+
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            yield from pool.map(bundle.compile_etype, filenames)
@@ -0,0 +1,100 @@
+"""
+Structured tracing of scripted entity calls.
+
+Tracing is off by default and costs a single attribute check per call
+while off. Once a Tracer is installed (see GameWorld.enable_tracing),
+calls matching its filters are timed and recorded into a fixed-size
+ring buffer, oldest records dropping off first.
+"""
+
+import random
+import time
+
+from collections import deque, namedtuple
+
+
+CallRecord = namedtuple('CallRecord', ('tick', 'etype', 'variant', 'entity', 'function', 'funcspace', 'args', 'duration'))
+
+
+def summarize(arg, limit=40):
+    """A short, display-friendly summary of a call argument."""
+    name = getattr(arg, 'name', None)
+
+    if isinstance(name, str):
+        return name
+
+    entity = getattr(arg, 'entity', None) # player.PlayerInterface
+
+    if entity is not None:
+        return summarize(entity, limit)
+
+    res = repr(arg)
+
+    if len(res) > limit:
+        res = res[:limit - 3] + '...'
+
+    return res
+
+
+class Tracer(object):
+    """Records entity calls into a ring buffer.
+
+    etypes and functions restrict tracing to the given entity type IDs
+    and function names (None meaning all of them). sample_rate is the
+    fraction of matching calls actually recorded; rates can override it
+    per function name."""
+
+    def __init__(self, capacity=4096, etypes=None, functions=None, sample_rate=1.0, rates=None):
+        self.records = deque(maxlen=capacity)
+
+        self.etypes = set(etypes) if etypes is not None else None
+        self.functions = set(functions) if functions is not None else None
+        self.sample_rate = sample_rate
+        self.rates = dict(rates or {})
+
+        self.clock = time.perf_counter
+
+    def wants(self, etype, func):
+        if self.etypes is not None and etype not in self.etypes:
+            return False
+
+        if self.functions is not None and func not in self.functions:
+            return False
+
+        rate = self.rates.get(func, self.sample_rate)
+
+        return rate >= 1 or random.random() < rate
+
+    def call(self, entity, func, args, kwargs):
+        etype = entity.type
+        fn = etype.functions[func]
+
+        if not self.wants(etype.id, func):
+            return fn(entity, *args, **kwargs)
+
+        start = self.clock()
+
+        try:
+            return fn(entity, *args, **kwargs)
+
+        finally:
+            self.records.append(CallRecord(
+                entity.world.tick_count,
+                etype.id,
+                entity.spl[4],
+                entity.id,
+                func,
+                getattr(fn, '__funcspace', None),
+                tuple(summarize(a) for a in args),
+                self.clock() - start,
+            ))
+
+    def drain(self):
+        """Returns every buffered record, oldest first, and clears the buffer."""
+        res = list(self.records)
+        self.records.clear()
+
+        return res
+
+    def slowest(self, count=10):
+        return sorted(self.records, key=lambda r: r.duration, reverse=True)[:count]
@@ -1,4 +1,3 @@
-import random
 import logging
 
 def drops(event, entity):
@@ -13,7 +12,7 @@ def drops(event, entity):
 
         for item, amount in entity['drops'].items():
             if isinstance(amount, (tuple, list)):
-                amount = random.randint(amount[0], amount[1])
+                amount = entity.world.rng.spawning.randint(amount[0], amount[1])
 
             if item in entity.world.item_types:
                 if 'neverDrop' not in entity.world.find_item(item)['flags']: